@@ -0,0 +1,52 @@
+"""Benchmark generic.fuzzyprep and Series.to_fuzzy on a million names.
+
+    python benchmarks/fuzzyprep.py [n]
+"""
+import re, sys, random
+from string import punctuation
+from timeit import default_timer
+
+from stagelib.generic import fuzzyprep, remove_non_ascii
+
+WORDS = ['Acme', 'Holdings', 'Co.', 'LLC', 'Inc.', 'Smith & Sons', 'Trust',
+         'Capital', 'Partners,', 'L.P.', 'Group', 'd/b/a', 'International',
+         'Caf\xe9', 'North-West', 'Bank', 'of', 'the', 'Americas']
+
+def fuzzyprep_reference(x):
+    x = remove_non_ascii(x)
+    if not isinstance(x, str):
+        x = str(x)
+    return ''.join(re.split(r'\s+', x.translate(None, punctuation).lower()))
+
+def names(n, distinct = 50000):
+    random.seed(0)
+    pool = [' '.join(random.sample(WORDS, random.randint(2, 5))) for i in xrange(distinct)]
+    return [random.choice(pool) for i in xrange(n)]
+
+def timed(label, func, *args):
+    start = default_timer()
+    result = func(*args)
+    print "%-40s %8.3fs" % (label, default_timer() - start)
+    return result
+
+def main(n = 1000000):
+    data = names(n)
+    print "%s names, %s distinct" % (n, len(set(data)))
+    old = timed("fuzzyprep (reference, per value)", map, fuzzyprep_reference, data)
+    new = timed("fuzzyprep (per value)", map, fuzzyprep, data)
+    assert old == new
+
+    try:
+        import pandas as pd
+        import stagelib.dataframe
+    except ImportError:
+        print "pandas not available, skipping Series benchmarks."
+        return
+
+    series = pd.Series(data)
+    old = timed("Series.quickmap(fuzzyprep_reference)", series.quickmap, fuzzyprep_reference)
+    new = timed("Series.to_fuzzy", series.to_fuzzy)
+    assert (old == new).all()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,5 +1,5 @@
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import wraps
 import pandas as pd
 import numpy as np
@@ -7,7 +7,7 @@ from tabulate import tabulate
 
 import generic
 from generic import mergedicts, strip, to_single_space, remove_non_ascii, fuzzyprep, integer, floating_point, punctuation
-from timeutils import Date, is_dayfirst
+from timeutils import Date, DateParser, DATEPARTS, infer_dayfirst
 from fieldlearner import dedupefields
 
 pd.set_option('display.max_colwidth', -1)
@@ -117,7 +117,14 @@ def series_functions():
     _strip = quickmapper(strip)
     to_text = quickmapper(to_single_space)
     to_ascii = quickmapper(remove_non_ascii)
-    to_fuzzy = quickmapper(generic.fuzzyprep)
+
+    def to_fuzzy(self):
+        """Vectorized generic.fuzzyprep.  Each distinct value is prepped once
+        and broadcast back with np.take; nulls are left as np.nan.
+        """
+        codes, uniques = pd.factorize(self.values)
+        prepped = np.array([generic.fuzzyprep(x) for x in uniques] + [np.nan], dtype = object)
+        return pd.Series(prepped.take(codes), index = self.index, name = self.name)
 
     @dtypeobject
     def is_punctuation(self):
@@ -165,17 +172,31 @@ def series_functions():
         return super(pd.Series, self.loc[self.notnull()]).unique()
 
     def to_datetime(self, fmt = False, disect = False, force = False, *args, **kwds):
+        dayfirst, confidence = infer_dayfirst(self, source = kwds.pop('source', None))
+        if 'parser' not in kwds and not set(kwds) - {'fields'}: #pd.to_datetime options bypass the parser
+            kwds['parser'] = DateParser.get(self.name, dayfirst = dayfirst)
         return self.quickmap(Date.parse,
                       fmt = fmt,
                       force = force,
                       disect = disect,
-                      dayfirst = self.quickmap(is_dayfirst).any(),
+                      dayfirst = dayfirst,
                       *args, **kwds)
 
     def disectdate(self, fields = [], **kwds):
-        return pd.DataFrame(
-            self.to_datetime(disect = True, fields = fields, **kwds).tolist()
-                )
+        """DataFrame of date parts (year, month, day, ..., see DATEPARTS),
+        computed with the .dt accessor.
+
+        Parameters:
+        ----------
+        self : Series of dates (parsed with to_datetime unless already datetime64).
+        [fields] : Date parts to compute, all of them if empty. list
+        """
+        dates = self
+        if dates.dtype.kind != 'M':
+            dates = pd.to_datetime(self.to_datetime(**kwds), errors = 'coerce')
+        return pd.DataFrame(OrderedDict(
+            (k, getattr(dates.dt, DATEPARTS[k])) for k in fields or DATEPARTS
+                ), index = self.index)
 
     def modify(self, mask, ifvalue, elsevalue = None):
         """
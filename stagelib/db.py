@@ -1,47 +1,234 @@
-import os, sys, logging
+import os, sys, csv, time, logging
 from warnings import filterwarnings
 import MySQLdb
+from MySQLdb.cursors import SSCursor
 from functools import partial, wraps
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 from peewee import *
 from playhouse.shortcuts import RetryOperationalError
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
 
 from generic import reversedict, filterdict, logging_setup, chunker
-from files import joinpath, readjson
+from files import Csv, joinpath, readjson
 import dataframe
 
 filterwarnings('ignore', category = MySQLdb.Warning)
 db_logger = logging_setup(name = 'db', level = logging.INFO)
 
+POOLSIZE = 8
+STALE_TIMEOUT = 300
+BATCHSIZE = 5000
+READ_CHUNKSIZE = 50000
+PACKET_HEADROOM = 0.8
+BATCH_ERRORS = (IntegrityError, DataError) #row-level; anything else is raised
+
+INSERT_SQL = "INSERT INTO {table} ({columns}) VALUES ({values})"
+CONFLICT_SQL = {
+    'mysql' : {
+        'ignore' : "INSERT IGNORE INTO {table} ({columns}) VALUES ({values})",
+        'replace' : INSERT_SQL + " ON DUPLICATE KEY UPDATE {updates}",
+        'update' : "{column} = VALUES({column})",
+            },
+    'sqlite' : {
+        'ignore' : "INSERT OR IGNORE INTO {table} ({columns}) VALUES ({values})",
+        'replace' : INSERT_SQL + " ON CONFLICT ({keys}) DO UPDATE SET {updates}", #sqlite >= 3.24
+        'update' : "{column} = excluded.{column}",
+            },
+    'postgres' : {
+        'ignore' : INSERT_SQL + " ON CONFLICT DO NOTHING",
+        'replace' : INSERT_SQL + " ON CONFLICT ({keys}) DO UPDATE SET {updates}",
+        'update' : "{column} = EXCLUDED.{column}",
+            },
+        }
+
+FIELD_DTYPES = {
+    'int' : 'int64',
+    'bigint' : 'int64',
+    'smallint' : 'int64',
+    'primary_key' : 'int64',
+    'float' : 'float64',
+    'double' : 'float64',
+    'decimal' : 'float64',
+    'bool' : 'bool',
+    'datetime' : 'datetime64[ns]',
+    'date' : 'datetime64[ns]',
+        }
+
+CREDENTIALS = {}
+DATABASES = {}
+
 def _get_credentials(path = 'login.json'):
-    return readjson(path)
+    path = os.path.abspath(path)
+    if path not in CREDENTIALS:
+        CREDENTIALS[path] = readjson(path)
+    return CREDENTIALS[path]
 
 def getdb(dbname, flavor = 'mysql', path = 'login.json', hostalias = 'localhost', **kwds):
+    """Pooled database for `dbname`.  Databases are cached per name and
+    settings, so repeated calls in one run share the same connection pool.
+
+    Parameters:
+    ----------
+    flavor : str
+        Key of `dbclasses`.
+    path, hostalias : str
+        Credentials file and host entry, used when no connection kwds are given.
+    **kwds : connection arguments; `max_connections` (default POOLSIZE) and
+        `stale_timeout` (seconds, default STALE_TIMEOUT) size the pool.
+    """
     if not kwds:
         kwds = _get_credentials(path)[hostalias]
-    return dbclasses()[flavor](dbname, **kwds)
+    kwds = dict(kwds)
+    kwds.setdefault('max_connections', POOLSIZE)
+    kwds.setdefault('stale_timeout', STALE_TIMEOUT)
+    key = (flavor, dbname, tuple(sorted(kwds.items())))
+    if key not in DATABASES:
+        DATABASES[key] = dbclasses()[flavor](dbname, **kwds)
+    return DATABASES[key]
+
+def closedbs():
+    for database in DATABASES.values():
+        database.close_all()
+    DATABASES.clear()
 
 def dbclasses():
-    return {'mysql' : CustomMySQLDatabase, 'sqllite' : SqliteDatabase}
+    return {'mysql' : CustomMySQLDatabase,
+            'sqllite' : CustomSqliteDatabase,
+            'sqlite' : CustomSqliteDatabase}
 
 def to_rows(query):
     return list(query.dicts().execute())
 
+def _typedseries(values, dtype):
+    series = pd.Series(values)
+    if not dtype:
+        return series
+    if dtype.startswith('datetime'):
+        return pd.to_datetime(series, errors = 'coerce')
+    if series.isnull().any():
+        if dtype == 'bool':
+            return series
+        if dtype == 'int64':
+            dtype = 'float64'
+    return series.astype(dtype)
+
+def _typedframe(rows, columns, dtypes):
+    if not rows:
+        return pd.DataFrame(columns = columns)
+    df = pd.DataFrame({i : _typedseries(values, dtype) for i, (values, dtype)
+                       in enumerate(zip(zip(*rows), dtypes))})
+    df.columns = columns
+    return df
+
+def _execute(query, serverside = False):
+    """Run `query` on a plain cursor (server-side on MySQL when `serverside`)
+    and work out column names and dtypes from the selected peewee fields.
+    """
+    database = query.database
+    conn = database.get_conn()
+    if serverside and get_dialect(database) == 'mysql':
+        cursor = conn.cursor(SSCursor)
+    else:
+        cursor = conn.cursor()
+
+    sql, params = query.sql()
+    with database.exception_wrapper:
+        cursor.execute(sql, params)
+
+    columns, dtypes = [], []
+    for node, description in zip(query._select, cursor.description):
+        if isinstance(node, Field):
+            columns.append(node._alias or node.name)
+            dtypes.append(FIELD_DTYPES.get(node.db_field))
+        else:
+            columns.append(description[0])
+            dtypes.append(None)
+    return cursor, columns, dtypes
+
+def iter_dataframe(query, chunksize = READ_CHUNKSIZE, cleanup = False):
+    """Yield the results of `query` as DataFrames of up to `chunksize` rows,
+    fetched from a server-side cursor so the full result never sits in memory.
+    Don't issue other queries on the same connection until it is exhausted.
+    """
+    cursor, columns, dtypes = _execute(query, serverside = True)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            df = _typedframe(rows, columns, dtypes)
+            if cleanup:
+                df = df.clean()
+            yield df
+    finally:
+        cursor.close()
+
 def to_dataframe(query, cleanup = False):
-    df = pd.DataFrame(to_rows(query))
+    cursor, columns, dtypes = _execute(query)
+    try:
+        df = _typedframe(cursor.fetchall(), columns, dtypes)
+    finally:
+        cursor.close()
     if cleanup:
         return df.clean()
     return df
 
+def to_records(df):
+    """Row tuples of plain python values (NULL for missing) ready for `executemany`."""
+    records = df.astype(object)
+    for name in df.select_dtypes(include = ['datetime']).columns:
+        records[name] = pd.Series(df[name].dt.to_pydatetime(), index = df.index, dtype = object)
+    df = records
+    return map(tuple, df.where(df.notnull(), None).values.tolist())
+
+def get_dialect(database):
+    database = getattr(database, 'obj', database) #unwrap Proxy
+    for dbclass, dialect in [(MySQLDatabase, 'mysql'),
+                             (SqliteDatabase, 'sqlite'),
+                             (PostgresqlDatabase, 'postgres')]:
+        if isinstance(database, dbclass):
+            return dialect
+
+def rowbytes(records, samplesize = 100):
+    """Rough size (in bytes) of one row once rendered into a VALUES clause."""
+    sample = records[:samplesize]
+    if not sample:
+        return 0
+    return sum(len(repr(value)) + 2 for row in sample for value in row) // len(sample) + 2
+
+def get_batchsize(database, records, default = BATCHSIZE):
+    """Number of rows per `executemany` call.
+
+    Servers with a packet limit (MySQL's max_allowed_packet) get batches sized
+    so that one multi-row INSERT stays under the limit; anything else uses `default`.
+    """
+    limit = getattr(database, 'packetlimit', None)
+    size = rowbytes(records)
+    if not (limit and size):
+        return default
+    return max(1, min(default, int(limit * PACKET_HEADROOM) // size))
+
 def connected(func):
+    """Pass `func` a raw cursor on the connection the database is already
+    using in this thread, or one borrowed from its pool and handed back afterwards.
+    """
+    @wraps(func)
     def inner(database, *args, **kwds):
-        conn = database._create_connection()
-        cursor = conn.cursor()
+        borrowed = database.is_closed()
+        if borrowed:
+            database.connect()
+        cursor = database.get_cursor()
         try:
-            return func(database, cursor, *args, **kwds)
+            with database.exception_wrapper:
+                result = func(database, cursor, *args, **kwds)
+            if database.get_autocommit() and not database.transaction_depth():
+                database.commit()
+            return result
         finally:
             cursor.close()
-            conn.close()
+            if borrowed:
+                database.close()
     return inner
 
 def _dataframe(func):
@@ -85,32 +272,139 @@ def get_basemodel(database):
             return cls.insert_many(rows).execute()
 
         @classmethod
-        @_insertdecorator
-        def tryinsert(cls, rows, **kwds):
-            inserted = []
-            for row in rows:
-                try:
-                    inserted.append(cls.insert(**row).execute())
-                except IntegrityError as e:
-                    db_logger.error(e)
-                except OperationalError as e:
-                    db_logger.error(e)
-            return len(inserted)
+        def tryinsert(cls, rows, conflict = None, **kwds):
+            return cls.loaddf(pd.DataFrame(rows), conflict = conflict, **kwds)
 
         @classmethod
         def insertdf(cls, df, bulk = False, **kwds):
-            rows = df.to_dict(orient = 'records')
-            if not rows:
-                db_logger.warning("Nothing to insert (%s).  All fields ('%s') are blank." % (cls.__name__, ', '.join(fields)))
+            if df.empty:
+                db_logger.warning("Nothing to insert (%s).  All fields ('%s') are blank." % (cls.__name__, ', '.join(df.columns)))
                 return
 
             if bulk:
-                return cls.bulkinsert(rows, **kwds)
-            return cls.tryinsert(rows, **kwds)
+                return cls.bulkinsert(df.to_dict(orient = 'records'), **kwds)
+            return cls.loaddf(df, **kwds)
+
+        @classmethod
+        def _insertsql(cls, fields, conflict = None):
+            database = cls._meta.database
+            quote = database.compiler().quote
+            template = INSERT_SQL
+            if conflict:
+                templates = CONFLICT_SQL[get_dialect(database)]
+                template = templates[conflict]
+
+            columns = [quote(f.db_column) for f in fields]
+            #conflict target: one constraint only, the frame's unique key or else the primary key
+            key = next((f for f in fields if f.unique and not f.primary_key), None) or\
+                next((f for f in fields if f.primary_key), None)
+            if conflict == 'replace' and '{keys}' in template and not key:
+                raise ValueError("'replace' needs a unique or primary key field among %s" % columns)
+
+            keys = [quote(f.db_column) for f in fields if f.primary_key or f is key]
+            return template.format(table = quote(cls._meta.db_table),
+                columns = ', '.join(columns),
+                values = ', '.join([database.interpolation] * len(fields)),
+                keys = quote(key.db_column) if key else '',
+                updates = ', '.join(templates.get('update', '').format(column = c)
+                                    for c in ([c for c in columns if c not in keys] or columns)) if conflict else '')
+
+        @classmethod
+        def _insertbatch(cls, cursor, sql, batch, rejected):
+            """Insert `batch` under a savepoint.  If it fails, split it in
+            half and retry each half, so that only the offending rows are
+            left out; those end up in `rejected` as (row, error) pairs.
+            """
+            database = cls._meta.database
+            try:
+                with database.savepoint():
+                    with database.exception_wrapper:
+                        cursor.executemany(sql, batch)
+                return len(batch)
+            except BATCH_ERRORS as e:
+                if len(batch) == 1:
+                    rejected.append((batch[0], e))
+                    return 0
+                half = len(batch) // 2
+                return (cls._insertbatch(cursor, sql, batch[:half], rejected) +
+                        cls._insertbatch(cursor, sql, batch[half:], rejected))
+
+        @classmethod
+        def loaddf(cls, df, batchsize = None, conflict = None, bisect = True, rejected = None):
+            """Insert one DataFrame as batched row tuples.
+            Columns are projected onto the model's fields once per chunk.
+
+            Parameters:
+            ----------
+            conflict : str, optional
+                'ignore' skips rows that collide with an existing key,
+                'replace' overwrites them (INSERT IGNORE / ON DUPLICATE KEY UPDATE
+                on MySQL, INSERT OR IGNORE / ON CONFLICT DO UPDATE on SQLite,
+                ON CONFLICT on PostgreSQL).  'replace' updates the existing row
+                in place, keyed on the frame's unique field, or else its primary key.
+            bisect : bool
+                Isolate rows that make a batch fail instead of aborting the load.
+            rejected : list, optional
+                Rows left out by `bisect` are appended here as dicts
+                (with the database error under 'error').
+            """
+            fields = [f for f in cls._meta.sorted_fields if f.name in df.columns]
+            if df.empty or not fields:
+                return 0
+
+            database = cls._meta.database
+            names = [f.name for f in fields]
+            records = to_records(df[names])
+            batchsize = batchsize or get_batchsize(database, records)
+            sql = cls._insertsql(fields, conflict = conflict)
+            failed = []
+            inserted = 0
+            with database.atomic():
+                cursor = database.get_cursor()
+                try:
+                    for batch in chunker(records, batchsize):
+                        if bisect:
+                            inserted += cls._insertbatch(cursor, sql, batch, failed)
+                        else:
+                            with database.exception_wrapper:
+                                cursor.executemany(sql, batch)
+                            inserted += len(batch)
+                finally:
+                    cursor.close()
+
+            if failed:
+                db_logger.error("%s rows rejected by '%s' (first error: %s)" % (len(failed), cls._meta.db_table, failed[0][1]))
+                if rejected is not None:
+                    rejected.extend(dict(zip(names, row), error = str(e)) for row, e in failed)
+            return inserted
+
+        @classmethod
+        def loaddfs(cls, dfs, batchsize = None, **kwds):
+            """Stream an iterable of DataFrames (e.g. `Stage.iterprocess`) into the table.
+
+            Parameters:
+            ----------
+            dfs : DataFrame or iterable of DataFrames.
+            batchsize : int, optional
+                Rows per `executemany` call.  Derived from the server's
+                packet limit when omitted.
+            **kwds : `conflict`, `bisect` and `rejected`, see `loaddf`.
+            """
+            if isinstance(dfs, pd.DataFrame):
+                dfs = [dfs]
+
+            tablename = cls._meta.db_table
+            db_logger.info("Streaming insertion queued for table '%s'" % tablename)
+            inserted = 0
+            for df in dfs:
+                inserted += cls.loaddf(df, batchsize = batchsize, **kwds)
+            db_logger.info("%s rows successfully inserted into '%s'" % (inserted, tablename))
+            return inserted
 
         @classmethod
         def getdict(cls, field, reversed = False):
-            __ = {row.id : getattr(row, field) for row in cls.select()}
+            query = cls.select(cls._meta.primary_key, getattr(cls, field))
+            __ = dict(query.tuples())
             if reversed:
                 return reversedict(__)
             return __
@@ -125,7 +419,17 @@ def get_basemodel(database):
     dbproxy.initialize(database)
     return BaseModel
 
-class CustomMySQLDatabase(RetryOperationalError, MySQLDatabase):
+class CustomMySQLDatabase(RetryOperationalError, PooledMySQLDatabase):
+    """MySQL connection pool; connections are pinged on checkout and
+    recycled after `stale_timeout` seconds.
+    """
+
+    @property
+    def packetlimit(self):
+        if not hasattr(self, '_packetlimit'):
+            cursor = self.execute_sql("SHOW VARIABLES LIKE 'max_allowed_packet'")
+            self._packetlimit = int(cursor.fetchone()[1])
+        return self._packetlimit
 
     @connected
     def loadcsv(self, cursor, path, table, overwrite = False, fields = [], lineterminator = '\n'):
@@ -135,7 +439,7 @@ class CustomMySQLDatabase(RetryOperationalError, MySQLDatabase):
         if sys.platform == 'win32':
             path = path.replace(os.sep, os.altsep)
         if not fields:
-            fields = Csv(path).testrows[0]
+            fields = Csv.readheader(path)
         if overwrite:
             db_logger.warning("Overwriting table '%s' with contents of '%s'." % (table, path))
             cursor.execute('TRUNCATE %s' % table)
@@ -155,3 +459,88 @@ class CustomMySQLDatabase(RetryOperationalError, MySQLDatabase):
                     fields = ','.join("`%s`" % s for s in fields),
                     lineterminator = lineterminator
                         ))
+
+class CustomSqliteDatabase(PooledSqliteDatabase):
+    """SQLite counterpart of CustomMySQLDatabase (e.g. for testing);
+    `loadcsv` streams the file through executemany instead of LOAD DATA.
+    """
+
+    @connected
+    def loadcsv(self, cursor, path, table, overwrite = False, fields = [], lineterminator = '\n', batchsize = BATCHSIZE):
+        if not fields:
+            fields = Csv.readheader(path)
+        quote = self.compiler().quote
+        if overwrite:
+            db_logger.warning("Overwriting table '%s' with contents of '%s'." % (table, path))
+            cursor.execute('DELETE FROM %s' % quote(table))
+
+        db_logger.info("Importing '%s' into '%s'" % (path, table))
+        sql = INSERT_SQL.format(table = quote(table),
+            columns = ', '.join(quote(s) for s in fields),
+            values = ', '.join([self.interpolation] * len(fields)))
+
+        loaded = 0
+        with open(path, 'rb') as fh, self.atomic():
+            reader = csv.reader(fh)
+            next(reader, None)
+            for rows in chunker(reader, batchsize):
+                cursor.executemany(sql, [[value.decode('utf-8', 'replace') for value in row] for row in rows])
+                loaded += len(rows)
+        return loaded
+
+def loadcsvs(database, paths, table, threads = POOLSIZE, overwrite = False, **kwds):
+    """Load many csv files (e.g. a folder of `Stage` output) into one table,
+    each over its own pooled connection.
+
+    Parameters:
+    ----------
+    database : CustomMySQLDatabase or CustomSqliteDatabase.
+    paths : list of csv files sharing `table`'s layout.
+    threads : int
+        Files loaded concurrently (SQLite takes one writer at a time, so
+        it always loads serially).
+    overwrite : bool
+        Empty `table` once before loading.
+    **kwds : passed on to `database.loadcsv`.
+
+    Returns:
+    --------
+    DataFrame with rows, seconds, rows_per_sec, mb_per_sec (and error) per file.
+    """
+    if overwrite:
+        db_logger.warning("Overwriting table '%s'." % table)
+        database.execute_sql('DELETE FROM %s' % database.compiler().quote(table))
+
+    def load(path):
+        stats = {'path' : path, 'rows' : 0, 'error' : None}
+        start, size = time.time(), 0
+        try:
+            size = os.path.getsize(path)
+            stats['rows'] = database.loadcsv(path, table, **kwds)
+        except (DatabaseError, EnvironmentError, csv.Error) as e:
+            db_logger.error("Could not load '%s': %s" % (path, e))
+            stats['error'] = str(e)
+        stats['seconds'] = time.time() - start
+        stats['rows_per_sec'] = stats['rows'] / max(stats['seconds'], 1e-6)
+        stats['mb_per_sec'] = size / 1048576. / max(stats['seconds'], 1e-6)
+        db_logger.info("'%s': %s rows in %.2fs (%.0f rows/s)" % (
+            path, stats['rows'], stats['seconds'], stats['rows_per_sec']))
+        return stats
+
+    if get_dialect(database) == 'sqlite':
+        threads = 1
+    threads = max(1, min(threads, len(paths)))
+    start = time.time()
+    if threads == 1:
+        stats = map(load, paths)
+    else:
+        pool = ThreadPool(threads)
+        try:
+            stats = pool.map(load, paths)
+        finally:
+            pool.close(); pool.join()
+
+    report = pd.DataFrame(stats, columns = ['path', 'rows', 'seconds', 'rows_per_sec', 'mb_per_sec', 'error'])
+    db_logger.info("%s rows loaded into '%s' from %s files in %.2fs" % (
+        report.rows.sum(), table, len(report), time.time() - start))
+    return report
@@ -1,7 +1,7 @@
 from __future__ import division
 import os, sys, io, csv, re, gc, xlrd, json, zipfile
 import xml.etree.cElementTree as ET
-import shutil, subprocess, hashlib, contextlib
+import shutil, subprocess, hashlib, contextlib, sqlite3
 from datetime import date
 from string import punctuation
 from cStringIO import StringIO
@@ -15,6 +15,8 @@ from timeutils import utcnow
 pd = None
 np = None
 DELIMITERS = '|,\t;:'
+EXCEL_MAXROWS = 1048576
+EXCEL_DATEFORMAT = 'yyyy-mm-dd hh:mm:ss'
 re_ERROR = re.compile(r'^Skipping line (?P<line>\d+): expected (?P<expected_length>\d+) fields, saw (?P<length>\d+)$')
 re_KEY = re.compile(r'((?<=get)(size|[a-z]time)|([a-z]+name|^ext$))')
 re_BADTAIL = re.compile(r'(^.*?"),"\n', re.M)
@@ -164,21 +166,81 @@ def parsexml(path, tagstart, tagstop):
 def xml2df(path, *args):
     return pd.DataFrame(  parsexml(path, *args)  )
 
+def excelvalue(x):
+    """Cell value for xlsxwriter: nulls (NaT included) become blanks,
+        Timestamps plain datetimes (written as date cells).
+    """
+    if pd.isnull(x):
+        return None
+    elif isinstance(x, pd.Timestamp):
+        return x.to_pydatetime()
+    return x
+
+def excelsheets(workbook, name, header):
+    """Yield new worksheets ('name', 'name_2', 'name_3', ...) with header written."""
+    shard = 1
+    while True:
+        sheetname = name if shard == 1 else "%s_%s" % (name[:30 - len(str(shard))], shard)
+        worksheet = workbook.add_worksheet(sheetname[:31])
+        worksheet.write_row(0, 0, [x if isinstance(x, basestring) else str(x) for x in header])
+        yield worksheet
+        shard += 1
+
+@importpandas
+def writesheet(workbook, name, data, keepindex = False, maxrows = EXCEL_MAXROWS):
+    """Write a pd.DataFrame, or an iterable of pd.DataFrame chunks, to
+        workbook row by row.  Rows beyond maxrows (header included) are
+        continued on a new numbered sheet.  Returns the number of rows written.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    sheets, header, worksheet, row, count = None, None, None, maxrows, 0
+    for df in data:
+        if keepindex:
+            df = df.reset_index()
+
+        if header is None:
+            header = list(df.columns)
+            sheets = excelsheets(workbook, name, header)
+            worksheet, row = next(sheets), 1
+
+        for values in df.reindex(columns = header).itertuples(index = False):
+            if row >= maxrows:
+                worksheet, row = next(sheets), 1
+            worksheet.write_row(row, 0, map(excelvalue, values))
+            row += 1; count += 1
+
+    if header is None:
+        workbook.add_worksheet(name[:31])
+    return count
+
 @importpandas
-def df2excel(outfile, keepindex = False, df = None, **kwds):
-    xlwriter = pd.ExcelWriter(outfile)
+def df2excel(outfile, keepindex = False, df = None, maxrows = EXCEL_MAXROWS, **kwds):
+    """Write sheets to an .xlsx file in constant memory (xlsxwriter).
+
+    Parameters:
+    -----------
+    outfile : Path of the workbook to create. str
+    [keepindex] : Flag to write the index as column(s).  bool
+    [df] : Data for 'Sheet1'.  pd.DataFrame or iterable of pd.DataFrame
+    [maxrows] : Row limit per sheet before continuing on 'sheetname_2', etc. int
+    [kwds] : Sheet name -> pd.DataFrame or iterable of pd.DataFrame chunks.
+    """
+    import xlsxwriter
     if df is not None:
         kwds = mergedicts({'Sheet1' : df}, kwds)
 
-    for sheetname, _df in kwds.items():
-        if keepindex:
-            _df.reset_index(inplace = True)
-
-        _df.to_excel(xlwriter,
-            sheet_name = sheetname,
-            index = False,
-            encoding = 'utf-8')
-    xlwriter.save()
+    workbook = xlsxwriter.Workbook(outfile, {'constant_memory' : True,
+                                             'default_date_format' : EXCEL_DATEFORMAT,
+                                             'remove_timezone' : True})
+    try:
+        for sheetname, data in kwds.items():
+            count = writesheet(workbook, sheetname, data,
+                               keepindex = keepindex, maxrows = maxrows)
+            files_logger.info("%s rows written to sheet '%s'" % (count, sheetname))
+    finally:
+        workbook.close()
 
 #MISC
 @filehandler()
@@ -193,6 +255,60 @@ def createcsv(fh, fields, **kwds):
     csvwriter = csv.writer(fh, **kwds)
     csvwriter.writerow(fields)
 
+def sqltext(value):
+    """Text safe to bind as a sqlite3 parameter under py2 (which refuses
+        non-ascii byte strings): utf-8 byte strings are decoded, anything
+        else undecodable is read as latin-1 (lossless).
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    return value
+
+def jsondumps(value):
+    try:
+        return json.dumps(value, encoding = 'utf-8')
+    except UnicodeDecodeError:
+        return json.dumps(value, encoding = 'latin-1')
+
+class DiskCache(object):
+    """Persistent key -> value store backed by sqlite3 (values are json encoded).
+        Safe to share between runs, files and worker processes.
+
+    Parameters:
+    -----------
+    path : Database file. str
+    [table] : Table name. str
+    """
+    def __init__(self, path, table = 'cache'):
+        self.path = path
+        self.table = table
+        with contextlib.closing(self.connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)" % table)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.path)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout = 60)
+
+    def get_many(self, keys):
+        """Cached values for `keys`, keyed the way they were passed in."""
+        keys = {sqltext(k) : k for k in keys}
+        found = {}
+        with contextlib.closing(self.connect()) as conn:
+            for _keys in chunker(keys, 900): #SQLITE_MAX_VARIABLE_NUMBER
+                found.update((keys[k], json.loads(v)) for k, v in conn.execute(
+                    "SELECT key, value FROM %s WHERE key IN (%s)" % (self.table, ','.join('?' * len(_keys))), _keys))
+        return found
+
+    def update(self, data):
+        with contextlib.closing(self.connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)" % self.table,
+                             ((sqltext(k), jsondumps(v)) for k, v in data.items()))
+
 def tsparse(timestamp, strfmt = "%Y-%m-%d %I:%M:%S"): #parse file timestamp
     return date.fromtimestamp(timestamp).strftime(strfmt)
 
@@ -255,7 +371,125 @@ class NotSupported(Exception):
                 setattr(self, "error_%s" % i, arg)
         super(NotSupported, self).__init__("File extension '%s' is currently not supported." % self.extension)
 
+class LineIndex(object):
+    """Byte offsets of the start of each line in a file, optionally saved to a
+        sidecar file ('<path>.lineindex.npz') and reused until the file changes.
+        Files larger than SPARSE_SIZE only keep every STEP'th offset; lookups
+        seek to the nearest checkpoint and read forward from there.
+
+    Parameters:
+    -----------
+    path : File path. str
+    offsets : Line start offsets (every step'th line). np.ndarray
+    step : Lines per checkpoint. int
+    count : Number of lines. int
+    newlines : Number of newline characters. int
+    size, mtime : Size and modification time of the file indexed.
+    """
+    STEP = 1000
+    SPARSE_SIZE = 256 * (1024 * 1024)
+
+    def __init__(self, path, offsets, step, count, newlines, size, mtime):
+        self.path = path
+        self.offsets = offsets
+        self.step = step
+        self.count = count
+        self.newlines = newlines
+        self.size = size
+        self.mtime = mtime
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def sidecar(path):
+        return "%s.lineindex.npz" % path
+
+    @property
+    def fresh(self):
+        __ = os.stat(self.path)
+        return (__.st_size, __.st_mtime) == (self.size, self.mtime)
+
+    @classmethod
+    @importpandas
+    def build(cls, path, step = None, chunksize = 600000):
+        __ = os.stat(path)
+        if step is None:
+            step = cls.STEP if __.st_size > cls.SPARSE_SIZE else 1
+
+        offsets, newlines, position, tail = [np.zeros(1, dtype = np.uint64)], 0, 0, ''
+        with open(path, 'rb') as fh:
+            while True:
+                data = fh.read(chunksize)
+                if not data:
+                    break
+                #line number (0 based) and offset of each line following a newline
+                starts = np.flatnonzero(np.frombuffer(data, dtype = np.uint8) == 10)
+                lines = np.arange(newlines + 1, newlines + len(starts) + 1)
+                offsets.append((starts[lines % step == 0] + position + 1).astype(np.uint64))
+                newlines += len(starts); position += len(data); tail = data[-1]
+
+        count = newlines + (1 if tail and tail != '\n' else 0)
+        return cls(path, np.concatenate(offsets), step, count, newlines, __.st_size, __.st_mtime)
+
+    @classmethod
+    @importpandas
+    def load(cls, path, save = False):
+        """Load the sidecar index for path if it is current, otherwise build one
+            (and write it to the sidecar if save is True).
+        """
+        sidecar = cls.sidecar(path)
+        if ospath.exists(sidecar):
+            with np.load(sidecar) as __:
+                step, count, newlines, size, mtime = __['meta']
+                index = cls(path, __['offsets'], int(step), int(count), int(newlines), int(size), mtime)
+            if index.fresh:
+                return index
+
+        index = cls.build(path)
+        if save:
+            index.save()
+        return index
+
+    @importpandas
+    def save(self):
+        try:
+            with open(self.sidecar(self.path), 'wb') as fh:
+                np.savez(fh, offsets = self.offsets,
+                         meta = np.array([self.step, self.count, self.newlines, self.size, self.mtime], dtype = np.float64))
+        except (IOError, OSError) as e:
+            files_logger.warning("Line index for '%s' not saved: %s" % (self.path, e))
+
+    def seek(self, fh, linenumber):
+        """Position fh at the start of linenumber (1 based)."""
+        i = linenumber - 1
+        fh.seek(int(self.offsets[i // self.step]))
+        for _ in xrange(i % self.step):
+            fh.readline()
+
+    def readlines(self, linenumbers):
+        """Raw lines for each linenumber (1 based), in the order given."""
+        with open(self.path, 'rb') as fh:
+            lines = {}
+            for i in sorted(set(linenumbers)):
+                if 0 < i <= self.count:
+                    self.seek(fh, i)
+                    lines[i] = fh.readline()
+            return [lines.get(i) for i in linenumbers]
+
+    def slice(self, start = 0, stop = None):
+        """Raw lines[start:stop] (0 based, like list slicing)."""
+        start, stop, _ = slice(start, stop).indices(self.count)
+        lines = []
+        if start < stop:
+            with open(self.path, 'rb') as fh:
+                self.seek(fh, start + 1)
+                lines = [fh.readline() for _ in xrange(stop - start)]
+        return lines
+
 class File(ospath):
+    SAVE_LINEINDEX = False #keep '<path>.lineindex.npz' next to the file for reuse between runs
+
     def __init__(self, path, setuplogging = False, mode = "rb", chunksize = 5 * (1024*1024), **kwds):
         super(File, self).__init__(path, setuplogging = setuplogging, mode = mode, chunksize = chunksize, **kwds)
         self.kwds = kwds
@@ -332,12 +566,18 @@ class File(ospath):
             offset = self.tell()
         return count
 
+    @property
+    def lineindex(self):
+        if not getattr(self, '_lineindex', None) or not self._lineindex.fresh:
+            self._lineindex = LineIndex.load(self.path, save = self.SAVE_LINEINDEX)
+        return self._lineindex
+
     def countrows(self, **kwds):
         if not hasattr(self, 'rows_original'):
             if isinstance(self, Excel):
                 self.rows_original = sum(i.nrows for i in self.sheets)
-            else:
-                self.rows_original = self._countrows(**kwds)
+            else: #files using only '\r' line endings have no newlines to index.
+                self.rows_original = self.lineindex.newlines or self._countrows(**kwds)
         return self.rows_original
 
 class Tabular(File):
@@ -414,39 +654,94 @@ class Csv(Tabular):
             yield dictupgrade(__, int)
 
     @staticmethod
-    @importpandas
-    def locate_badlines(path, **kwds):
-        buf = StringIO()
-        with RedirectStdStreams(stdout = buf, stderr = buf):
-            dfreader = pd.read_csv(path, header = None,
-                error_bad_lines = False, chunksize = 285000, **kwds)
+    def scanlines(fh, **kwds):
+        """Single pass over a csv file handle (opened 'rb').
+            Yields (linenumber, offset, length) for each record, where offset
+            is the byte offset the record starts at and length its field count.
+
+        Parameters:
+        -----------
+        fh : File handle.
+        [kwds] : csv.reader keyword arguments, e.g. delimiter.
+        """
+        offsets = []
+        def lines():
+            while True:
+                offsets.append(fh.tell())
+                line = fh.readline()
+                if not line:
+                    break
+                yield line
+
+        reader = csv.reader(lines(), **kwds)
+        consumed = 0
+        for i, row in enumerate(reader, 1):
+            yield i, offsets[0], len(row)
+            del offsets[:reader.line_num - consumed]
+            consumed = reader.line_num
 
-            for df in dfreader:
+    @staticmethod
+    @filehandler(mode = 'rb')
+    def locate_badlines(fh, delimiter = ',', **kwds):
+        """Find records whose field count differs from the first record's.
+            Returns a list of dicts (line, offset, expected_length, length).
+        """
+        badlines, expected = [], None
+        for i, offset, length in Csv.scanlines(fh, delimiter = str(delimiter)):
+            if not length:
                 continue
+            elif expected is None:
+                expected = length
+            elif length != expected:
+                badlines.append({'line' : i,
+                                 'offset' : offset,
+                                 'expected_length' : expected,
+                                 'length' : length})
+        return badlines
 
-        return list(Csv.errorparse( buf.getvalue() ))
+    @staticmethod
+    @filehandler(mode = 'rb')
+    def readrecords(fh, offsets, **kwds):
+        """Read the csv record starting at each byte offset."""
+        rows = []
+        for offset in offsets:
+            fh.seek(offset)
+            rows.append(next(csv.reader(iter(fh.readline, ''), **kwds)))
+        return rows
+
+    @staticmethod
+    @filehandler(mode = 'rb')
+    def readheader(fh, delimiter = ','):
+        """Field names from the first record only."""
+        return next(csv.reader(iter(fh.readline, ''), delimiter = str(delimiter)), [])
 
     @staticmethod
     @filehandler(mode = 'rb')
     def getlines(fh, linenumbers):
-        return [[i] + row for i, row in enumerate(csv.reader(fh), 1)
-                if i in linenumbers]
+        linenumbers = set(linenumbers)
+        last = max(linenumbers) if linenumbers else 0
+        rows = []
+        for i, row in enumerate(csv.reader(fh), 1):
+            if i > last:
+                break
+            elif i in linenumbers:
+                rows.append([i] + row)
+        return rows
 
     @staticmethod
     @importpandas
-    def savebadlines(path, badlines, outfile = '', **kwds):
+    def savebadlines(path, badlines, outfile = '', delimiter = ',', **kwds):
         if not outfile:
             outfile = "{}_badlines.xlsx".format(path)
 
-        df = pd.DataFrame(badlines)
-        for length, data in df.groupby('length'):
-            __ = pd.DataFrame(
-                Csv.getlines(path, data.line.values))
+        if not badlines:
+            return
 
-            __.rename(columns = {0 : 'line'},
-                      inplace = True)
-
-            sheets.update({ "length_{}".format(length) :  __})
+        sheets = OrderedDict()
+        for length, data in pd.DataFrame(badlines).groupby('length'):
+            rows = Csv.readrecords(path, data.offset.values, delimiter = str(delimiter))
+            __ = pd.DataFrame([[i] + row for i, row in zip(data.line.values, rows)])
+            sheets["length_{}".format(length)] = __.rename(columns = {0 : 'line'})
 
         df2excel(outfile,
                  **OrderedDict( mergedicts(sheets, kwds)) )
@@ -492,6 +787,15 @@ class Csv(Tabular):
         return [i for i in csv.reader(buf,
                 delimiter = self.delimiter, quoting = 1)]
 
+    def readlines(self, linenumbers):
+        """Parsed rows ([linenumber] + fields) for each line number (1 based), via the line index."""
+        return [[i] + (self.reader(line)[0] if line else [])
+                for i, line in zip(linenumbers, self.lineindex.readlines(linenumbers))]
+
+    def slice(self, start = 0, stop = None):
+        """Parsed rows for lines[start:stop] (0 based, like list slicing), via the line index."""
+        return self.reader(''.join(self.lineindex.slice(start, stop)))
+
     @Tabular._iterdataframe
     def _dfreader(self):
         self.kwds['chunksize'] = self.kwds.pop('chunksize', self.chunksize)
@@ -1,4 +1,5 @@
 import re
+import heapq
 import logging
 from functools import wraps
 import numpy as np
@@ -14,17 +15,31 @@ logging.basicConfig(format='%(asctime)s|%(message)s', datefmt='%Y-%m-%d %I:%M:%S
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def results_to_csv(outfile, df):
-    df.to_csv(outfile, index = False, encoding = 'utf-8')
+KEY_LENGTHS = (1, 2)
+
+def results_to_csv(outfile, df, mode = 'w'):
+    df.to_csv(outfile, index = False, encoding = 'utf-8',
+              mode = mode, header = (mode == 'w'))
 
 def disected_match(df, length = 1):
-    return df.apply(lambda x: disect_string(x['match_x'],
-        length = length) == disect_string(x['match_y'],
-        length = length), axis = 1)
+    """Compare the first 'length' words of match_x and match_y.
+        Uses the precomputed key columns (see 'matchkeys') when present.
+    """
+    x, y = ["key%s_%s" % (length, k) for k in ('x', 'y')]
+    if x in df.columns and y in df.columns:
+        return df[x] == df[y]
+    return firstwords(df['match_x'], length) == firstwords(df['match_y'], length)
 
 def disect_string(x, length = 1):
     return fuzzyprep(''.join(x.split()[0:length]))
 
+def firstwords(series, length = 1):
+    """Vectorized 'disect_string'."""
+    return series.str.split()\
+        .str[0:length]\
+        .str.join('')\
+        .to_fuzzy()
+
 @quickmapper
 def categorize_name(x, N = 3):
     """Find the first N elements of a name,
@@ -49,42 +64,62 @@ def categorize_name(x, N = 3):
     return fuzzyprep(x[i:])[:N]
 
 def fuzzytable(series):
-    return pd.DataFrame({'group' : categorize_name(series),
-                         'fuzzy' : series.fuzzyprep()}, index = series.index).dropna()
+    __ = {"key%s" % length : firstwords(series, length) for length in KEY_LENGTHS}
+    return pd.DataFrame(mergedicts(__,
+        group = categorize_name(series),
+        fuzzy = series.to_fuzzy()),
+            index = series.index).dropna(subset = ['group', 'fuzzy'])
 
-def get_exact_matches(x_df, y_df):
-    """Create a dictionary of fuzzy column values (keys) and index (value)
-        from y_df (matches FROM) and map it to the x_df (matches FOR) fuzzy column.
-        Returns a series which represents the index locations of matches FROM y_df.
-
-    Parameters:
-    ----------
-    x_df : The data you are trying to get matches FOR. pd.DataFrame
-    y_df : The data you are trying to pull matches FROM. pd.DataFrame
-    """
-    return x_df.fuzzy\
-        .map(y_df.reset_index()\
-        .getmapper('fuzzy', 'index'))\
-        .reindex(x_df.index)
-
-def create_groups(x_df, y_df):
-    """Create pd.DataFrame.groupby objects where there is
-        overlap in the 'letter_group' column between both datasets.
-    """
-    __ = {1 : x_df, 2 : y_df}
-    for i in range(1,3):
-        yield 'group%s' % i, __[i]\
-            .loc[__[i]\
-            .group\
-            .isin(__.get(i + 1, x_df)\
-            .group)]\
-            .groupby('group')
+def matchtable(df, match_col, suffix):
+    return fuzzytable(df[match_col]).assign(**{"match_%s" % suffix : df[match_col]})
 
 @quickmapper
 def get_fuzzy_ranking(x, y):
     return {'ratio_total' : fuzz.ratio(x, y),
             'ratio_partial' : fuzz.partial_ratio(x, y)}
 
+def score_bound(x, lengths):
+    """Upper bound of ratio_total + ratio_partial from string lengths alone.
+        fuzz.ratio can never exceed 2 * min(len(x), len(y)) / (len(x) + len(y)).
+    """
+    n = len(x)
+    return 100 + np.ceil(200.0 * np.minimum(n, lengths) / np.maximum(n + lengths, 1))
+
+def top_candidates(x, candidates, k = 1, cutoff = 0):
+    """Score x against candidates, keeping only the best k with a
+        score (ratio_total + ratio_partial) of at least cutoff.
+        Candidates are visited in order of their length bound
+        (see 'score_bound'), stopping as soon as no remaining candidate
+        can beat the current k best.
+        Returns a list of (position, ranking) tuples, best first.
+
+    Parameters:
+    ----------
+    x : Fuzzy prepped string to find matches FOR. str
+    candidates : Fuzzy prepped strings to pull matches FROM. pd.Series
+    [k] : Number of candidates to keep. int
+    [cutoff] : Minimum score (0 - 200) to keep. int
+    """
+    bounds = score_bound(x, candidates.str.len().values)
+    heap = []
+    for i in np.argsort(-bounds, kind = 'mergesort'):
+        if bounds[i] < cutoff or (len(heap) == k and bounds[i] <= heap[0][0]):
+            break
+
+        y = candidates.iat[i]
+        #(candidate, query), as in 'get_fuzzy_ranking'; the scorers aren't symmetric
+        total, partial = fuzz.ratio(y, x), fuzz.partial_ratio(y, x)
+        item = (total + partial, -i, total, partial)
+        if item[0] < cutoff:
+            continue
+        elif len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    return [(-i, {'ratio_total' : total, 'ratio_partial' : partial, 'rank' : rank})
+            for rank, (score, i, total, partial) in enumerate(sorted(heap, reverse = True), 1)]
+
 def is_a_partial_match(rankings, threshold = 70):
     return ((rankings['ratio_partial'] >= 97) & (rankings['ratio_total'] < threshold - 20))
 
@@ -112,6 +147,21 @@ def likely(df):
 def least_likely(df):
     return ~(most_likely(df)) & ~(likely(df))
 
+def likelihood(df):
+    return np.select([most_likely(df), likely(df)],
+                     ['most_likely', 'likely'], 'least_likely')
+
+def matchkeys(rankings, x_df, y_df):
+    """Look up the first word keys of each side by 'x_index' / 'y_index'
+        so 'disected_match' is a plain column comparison.
+    """
+    __ = {}
+    for k, v in (('x', x_df), ('y', y_df),):
+        for length in KEY_LENGTHS:
+            key = "key%s" % length
+            __["%s_%s" % (key, k)] = v[key].reindex(rankings["%s_index" % k]).values
+    return __
+
 def categorize_matches(rankings):
     __ = {
         'MATCH' : is_a_match(rankings),
@@ -125,13 +175,97 @@ def categorize_matches(rankings):
     return rankings.assign(
         score = rankings['ratio_total'] + rankings['ratio_partial'])
 
-def get_rankings(x_df, y_df, match_col, threshold = 88, **kwds):
+class FuzzyIndex(object):
+    """Pre-processed reference data (the 'y' side) for fuzzy matching.
+        Holds the fuzzy table, the exact match hash (fuzzy -> index)
+        and the category blocks so they can be built once, saved to disk
+        and reused by any number of match runs.
+
+    Parameters:
+    ----------
+    y_df : The data you are trying to pull matches FROM. pd.DataFrame
+    match_col : Common field name to match on. str
+    [table] : Existing fuzzy table to use in place of y_df. pd.DataFrame
+
+    Example:
+    --------
+    index = FuzzyIndex(companies, 'name'); index.save('companies.idx')
+    fuzzymatch(x_df, None, 'name', index = FuzzyIndex.load('companies.idx'))
+    """
+    def __init__(self, y_df = None, match_col = '', table = None):
+        self.match_col = match_col
+        if table is None:
+            table = matchtable(y_df, match_col, 'y')
+        self.table = table
+        self._reset()
+
+    def __len__(self):
+        return len(self.table)
+
+    @classmethod
+    def load(cls, path):
+        logger.info("Loading fuzzy index from '%s'" % path)
+        __ = pd.read_pickle(path)
+        index = cls(match_col = __['match_col'], table = __['table'])
+        index._exact = __['exact']
+        index._blocks = __['blocks']
+        return index
+
+    def save(self, path):
+        logger.info("Saving fuzzy index (%s rows) to '%s'" % (len(self), path))
+        pd.to_pickle({'match_col' : self.match_col,
+                      'table' : self.table,
+                      'exact' : self.exact,
+                      'blocks' : self.blocks}, path)
+
+    def _reset(self):
+        self._exact = None
+        self._blocks = None
+
+    @property
+    def exact(self):
+        if self._exact is None:
+            self._exact = dict(zip(self.table.fuzzy, self.table.index))
+        return self._exact
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = self.table.groupby('group').indices
+        return self._blocks
+
+    def getblock(self, name):
+        return self.table.iloc[self.blocks[name]]
+
+    def get_exact_matches(self, x_df):
+        """Series of reference index locations for x_df's exact fuzzy matches (NaN if none)."""
+        return x_df.fuzzy.map(self.exact).reindex(x_df.index)
+
+    def add(self, y_df):
+        """Add (or replace) reference rows.  Only the new rows are fuzzy prepped."""
+        table = matchtable(y_df, self.match_col, 'y')
+        self.table = pd.concat([self.table.drop(table.index, errors = 'ignore'), table])
+        self._reset()
+        return self
+
+    def remove(self, index):
+        self.table = self.table.drop(index, errors = 'ignore')
+        self._reset()
+        return self
+
+def get_rankings(x_df, y_df, match_col, threshold = 88, index = None, topk = None, cutoff = 0, **kwds):
+    """Exact, then fuzzy (by category group) matches of x_df against y_df.
+        By default every compared pair is kept.  When topk is given,
+        only the best topk candidates per x record scoring at least
+        cutoff are kept (see 'top_candidates') and a 'rank' column is added.
+    """
+    if index is None:
+        index = FuzzyIndex(y_df, match_col)
 
-    x, y = [fuzzytable(v[match_col]).assign(**{"match_%s" % k : v[match_col]})
-            for k, v in (['x', x_df], ['y', y_df],)]
+    x, y = matchtable(x_df, match_col, 'x'), index.table
 
     #Level 1 matches: Pre-processed exact.
-    match_index = get_exact_matches(x, y)
+    match_index = index.get_exact_matches(x)
     mdict = match_index\
         .loc[match_index.notnull()]\
         .to_numeric(integer = True)\
@@ -148,35 +282,43 @@ def get_rankings(x_df, y_df, match_col, threshold = 88, **kwds):
         'y_index' : y_ix},
             index = x_ix)
 
+    if topk:
+        rankings['rank'] = 1
+
     #Level 2 matches: By category groups.
-    groupdict = dict(create_groups(x.drop(x_ix), y))
-    for name, df in groupdict['group1']:
+    remaining = x.drop(x_ix)
+    for name, df in remaining.loc[remaining.group.isin(index.blocks.keys())].groupby('group'):
         data = []
-        group2 = groupdict['group2'].get_group(name)
+        group2 = index.getblock(name)
         logger.info("%s matches queued for strings beginning with '%s'" % (len(df) * len(group2), name))
         for i, row in df.iterrows():
             logger.info("Finding matches for '%s'" % row.match_x)
+            if topk:
+                ranked = top_candidates(row.fuzzy, group2.fuzzy, k = topk, cutoff = cutoff)
+            else:
+                ranked = enumerate(list(get_fuzzy_ranking(group2.fuzzy, row.fuzzy)))
+
             data.extend([
                 mergedicts(d, dict(row),
                     x_index = i,
                     y_index = group2.index[i2],
                     match_y = group2.iloc[i2]['match_y']
-                        ) for i2, d in enumerate(
-                            list(get_fuzzy_ranking(group2.fuzzy, row.fuzzy)))
+                        ) for i2, d in ranked
                                 ])
         rankings = rankings\
         .append(pd.DataFrame(data,
             columns = rankings.columns))
 
     logger.info("%s matches performed" % len(rankings))
-    return categorize_matches(rankings)
+    return categorize_matches(rankings.assign(**matchkeys(rankings, x, y)))
 
 def fuzzymatch(x_df, y_df, match_col, outfile_prefix = '', intern_folder = 'check', **kwds):
     match_groups = get_rankings(x_df,
         y_df, match_col, **kwds).groupby('match_category')
 
-    results_to_csv("%s_Non-matches.csv" % outfile_prefix,
-        match_groups.get_group('NON_MATCH'))
+    if 'NON_MATCH' in match_groups.groups:
+        results_to_csv("%s_Non-matches.csv" % outfile_prefix,
+            match_groups.get_group('NON_MATCH'))
     try:
         matches = match_groups.get_group('MATCH')
         results_to_csv("%s_Matches.csv" % outfile_prefix, matches)
@@ -184,6 +326,10 @@ def fuzzymatch(x_df, y_df, match_col, outfile_prefix = '', intern_folder = 'chec
         logger.error("No certain matches found.", exec_info = True)
         matches = pd.DataFrame()
 
+    if 'POSSIBLE_MATCH' not in match_groups.groups:
+        logger.info("No possible matches found.")
+        return matches
+
     internfile = joinpath(newfolder(intern_folder),
         "%s_Possible Matches.xlsx" % outfile_prefix)
 
@@ -200,8 +346,48 @@ def fuzzymatch(x_df, y_df, match_col, outfile_prefix = '', intern_folder = 'chec
                            for k, v in possible_match_groups.items()})
     return matches
 
+def fuzzymatch_stream(x_chunks, index, match_col = None, outfile_prefix = '', intern_folder = 'check', **kwds):
+    """Match an iterable of DataFrames (e.g. Tabular.dfreader) against
+        an indexed reference, one chunk at a time.  Results are appended
+        to the Matches / Non-matches / Possible Matches csv files as each
+        chunk is scored, so memory is bounded by the size of a chunk.
+        Returns a dictionary of counts per match category.
+
+    Parameters:
+    ----------
+    x_chunks : The data you are trying to get matches FOR. iterable of pd.DataFrame
+    index : The data you are trying to pull matches FROM. FuzzyIndex or pd.DataFrame
+    [match_col] : Common field name to match on.  Defaults to index.match_col. str
+    """
+    if not isinstance(index, FuzzyIndex):
+        index = FuzzyIndex(index, match_col)
+
+    match_col = match_col or index.match_col
+    outfiles = {
+        'MATCH' : "%s_Matches.csv" % outfile_prefix,
+        'NON_MATCH' : "%s_Non-matches.csv" % outfile_prefix,
+        'POSSIBLE_MATCH' : joinpath(newfolder(intern_folder),
+            "%s_Possible Matches.csv" % outfile_prefix)
+            }
+
+    counts = dict.fromkeys(outfiles, 0)
+    for i, x_df in enumerate(x_chunks, 1):
+        logger.info("Matching chunk %s (%s rows)" % (i, len(x_df)))
+        rankings = get_rankings(x_df, None, match_col, index = index, **kwds)
+        for category, df in rankings.groupby('match_category'):
+            if category == 'POSSIBLE_MATCH':
+                df = df.assign(likelihood = likelihood(df))
+
+            results_to_csv(outfiles[category], df,
+                mode = ('a' if counts[category] else 'w'))
+            counts[category] += len(df)
+
+    for category, count in counts.items():
+        logger.info("%s total results: %s ('%s')" % (category, count, outfiles[category]))
+    return counts
+
 def concat_matches(matches, x_df, y_df, x_suffix = "x", y_suffix = "y"):
-    return matches.filter(regex = '_index')\
+    return matches.filter(regex = r'_index$|^rank$')\
         .merge(x_df,
             left_on = 'x_index',
             right_index = True)\
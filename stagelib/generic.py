@@ -1,14 +1,17 @@
 import os, sys, re
-from string import ascii_letters, punctuation
+from string import ascii_letters, ascii_lowercase, ascii_uppercase, punctuation, whitespace, maketrans
 from datetime import datetime
 import logging
 import logging.handlers
 import logging.config
-from collections import MutableMapping
+from collections import MutableMapping, OrderedDict
 from itertools import islice
 from functools import wraps, partial
+from multiprocessing import Pool
 
 re_DOUBLESPACE = re.compile(r' {2,}')
+FUZZY_TABLE = maketrans(ascii_uppercase, ascii_lowercase)
+FUZZY_DELETE = punctuation + whitespace + ''.join(map(chr, range(128, 256)))
 LOGDIR = os.path.join(os.path.dirname(__file__), 'logs')
 
 def removehandlers(logger):
@@ -87,11 +90,93 @@ def chunker(iterable, chunksize = 675000):
             raise StopIteration
         yield __
 
+def poolmap(func, iterable, processes = None, minsize = 0, chunksize = 1, initializer = None):
+    """map(func, iterable) in a multiprocessing.Pool.  Falls back to
+        the builtin map when processes == 1 or there are fewer than
+        minsize items, where starting workers would cost more than it saves.
+    """
+    items = list(iterable)
+    if processes == 1 or len(items) < minsize:
+        return map(func, items)
+
+    pool = Pool(processes, initializer)
+    try:
+        return pool.map(func, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def poolimap(func, iterable, processes = None, minsize = 0, chunksize = 1):
+    """Like poolmap, but yields results in completion order as workers finish."""
+    items = list(iterable)
+    if processes == 1 or len(items) < minsize:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = Pool(processes)
+    exhausted = False
+    try:
+        for result in pool.imap_unordered(func, items, chunksize):
+            yield result
+        exhausted = True
+    finally:
+        if exhausted:
+            pool.close()
+        else: #closed early (or failed): don't wait for the queued work
+            pool.terminate()
+        pool.join()
+
 def loadcontainer(func, container = dict):
     def inner(*args, **kwds):
         return container(func(*args, **kwds))
     return inner
 
+class lazyclassattr(object):
+    """Class attribute computed by func(cls) on first access (from the
+        class or an instance), then stored on the class in place of itself.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        value = self.func(cls)
+        setattr(cls, self.__name__, value)
+        return value
+
+class LRUCache(object):
+    """Dictionary-like cache holding at most `maxsize` items,
+        evicting the least recently used one first.
+    """
+    def __init__(self, maxsize = 100000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last = False)
+
+    def get(self, key, default = None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def clear(self):
+        self._data.clear()
+
 def requiresattr(name):
     def decorator(func):
         @wraps(func)
@@ -177,18 +262,20 @@ def remove_non_ascii(x): return ''.join(i for i in x if ord(i) < 128)
 
 def fuzzyprep(x):
     """Remove whitespace, punctuation, and non-ascii characters
-        from x in preparation for fuzzy text matching.
+        from x and lower case it in preparation for fuzzy text matching.
+        Done in a single str.translate pass (see FUZZY_TABLE, FUZZY_DELETE).
 
     Parameters:
     -----------
     x : Item or string to parse. str
 
     """
-    x =  remove_non_ascii(x)
-    if not isinstance(x, str):
+    if isinstance(x, unicode):
+        x = x.encode('ascii', 'ignore')
+    elif not isinstance(x, str):
         x = str(x)
 
-    return ''.join(re.split(r'\s+', x.translate(None, punctuation).lower()))
+    return x.translate(FUZZY_TABLE, FUZZY_DELETE)
 
 @numeric
 def integer(x, **kwds):
@@ -1,4 +1,4 @@
-import os, sys, re
+import os, sys, re, sqlite3
 from collections import OrderedDict
 from functools import partial
 import numpy as np
@@ -6,20 +6,57 @@ import pandas as pd
 from more_itertools import unique_everseen as uniq
 import usaddress
 from nameparser import HumanName
+from nameparser.config import CONSTANTS
 
-from generic import strip, to_single_space, remove_non_ascii, idict
-from files import ospath, readjson, joinpath, newfolder
+from generic import strip, to_single_space, remove_non_ascii, idict, poolmap, lazyclassattr, logging_setup
+from files import ospath, readjson, joinpath, newfolder, DiskCache
 import dataframe
 from dataframe import dtypeobject
-from dataframe import quickmapper
 
 re_GARBAGEPHONE = re.compile(r'[\.\-\(\)\s]+')
 re_PHONE = re.compile(r'^\d+$')
 re_1800NUMBER = re.compile(r'^1-8\d{2}-')
+re_SIMPLENAME = re.compile(r'^([a-z]{2,})(?:\s+|\s*,\s*)([a-z]{2,})$', re.I)
+re_MACNAME = re.compile(r'^ma?c', re.I)
 
 newfolder = partial(newfolder, ospath.dirname(__file__))
 LABELDIR = newfolder('config', 'addresslabels')
 ZIPCODEDIR = newfolder('data', 'zipcodes')
+CACHEDIR = None #parse caches; defaults to $STAGELIB_CACHEDIR, then ~/.stagelib/cache
+POOL_MINSIZE = 2000
+ZIPINDEX = {}
+record_logger = logging_setup(name = __name__)
+
+def get_cachedir():
+    """Directory for the on-disk parse caches, created on first use."""
+    path = CACHEDIR or os.environ.get('STAGELIB_CACHEDIR') or\
+        os.path.join(os.path.expanduser('~'), '.stagelib', 'cache')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def get_cache(filename, cache = True):
+    """DiskCache `filename` in the cache directory, or None if caching is off
+        or the cache can't be opened (parsing then just runs uncached).
+
+    Parameters:
+    ----------
+    filename : Cache file name. str
+    [cache] : True for the default cache directory, a directory path, or False. bool / str
+    """
+    if not cache:
+        return None
+    try:
+        dirname = cache if isinstance(cache, basestring) else get_cachedir()
+        return DiskCache(os.path.join(dirname, filename))
+    except (IOError, OSError, sqlite3.Error) as e:
+        record_logger.warning("Parse cache '%s' unavailable, continuing without it (%s)" % (filename, e))
+
+def cache_update(store, data):
+    try:
+        store.update(data)
+    except (IOError, OSError, sqlite3.Error) as e:
+        record_logger.warning("Could not write to %r (%s)" % (store, e))
 
 #phone
 def get_phoneorfax(x):
@@ -31,9 +68,19 @@ def get_phoneorfax(x):
         return phoneorfax
     return x
 
-@quickmapper
-def to_phone(x):
-    return get_phoneorfax(x)
+def to_phone(self):
+    """Column level get_phoneorfax, e.g. '555.123.4567 x89' --> '(555) 123-4567 ext.89'.
+        Values that are not all digits once punctuation/whitespace is removed,
+        or that start with '1-8XX-', are left as is.
+    """
+    number = self.str.replace(re_GARBAGEPHONE.pattern, '')
+    mask = (number.str.contains(re_PHONE.pattern, na = False)) &\
+          ~(self.str.contains(re_1800NUMBER.pattern, na = False))
+
+    phone = '(' + number.str[0:3] + ') ' + number.str[3:6] + '-' + number.str[6:10]
+    phone = phone.modify(number.str.len() > 10,
+                         phone + ' ext.' + number.str[10:])
+    return self.modify(mask, phone)
 
 #names
 def getname(name):
@@ -41,12 +88,86 @@ def getname(name):
     return {'firstname' : "%s %s" % (h.first, h.middle),
             'lastname' : "%s %s" % (h.last, h.suffix)}
 
-def to_name(self):
-    return pd.DataFrame([
-        d for d in self.modify(
-            self.notnull(),
-            self.quickmap(getname)
-                )], index = self.index).clean()
+def is_plainword(word):
+    """True if HumanName would treat word as an ordinary first/last name piece."""
+    word = word.lower()
+    return not (re_MACNAME.match(word) or
+                any(word in i for i in (CONSTANTS.titles,
+                                        CONSTANTS.prefixes,
+                                        CONSTANTS.conjunctions,
+                                        CONSTANTS.suffix_acronyms,
+                                        CONSTANTS.suffix_not_acronyms,
+                                        CONSTANTS.capitalization_exceptions)))
+
+def quicksplit(name):
+    """(first, last) for simple "First Last" and "Last, First" names,
+        giving the same result as getname without running HumanName.
+        Returns None for anything else.
+    """
+    __ = re_SIMPLENAME.match(name)
+    if not __ or not all(map(is_plainword, __.groups())):
+        return
+
+    first, last = __.groups()
+    if ',' in name:
+        first, last = last, first
+
+    if name == name.upper() or name == name.lower():
+        first, last = first.capitalize(), last.capitalize()
+    return first, last
+
+def splitname(name):
+    __ = getname(name)
+    return __['firstname'].strip(), __['lastname'].strip()
+
+def splitnames(names, processes = None, cache = True):
+    """splitname over names, reading / writing the on-disk name cache (see get_cache)."""
+    names = set(names)
+    store = get_cache('names.db', cache = cache)
+    parsed = store.get_many(names) if store else {}
+    misses = [name for name in names if name not in parsed]
+    if misses:
+        __ = dict(zip(misses, poolmap(splitname, misses,
+            processes = processes, minsize = POOL_MINSIZE, chunksize = 250)))
+
+        parsed.update(__)
+        if store:
+            cache_update(store, __)
+    return parsed
+
+def to_name(self, **kwds):
+    """Split a series of names into 'firstname' and 'lastname' columns.
+        Each distinct name is split once; simple names take the 'quicksplit'
+        path and the rest go through HumanName via 'splitnames'.
+
+    Parameters:
+    ----------
+    self : pd.Series
+    [kwds] : Keyword arguments for splitnames (processes, cache).
+    """
+    codes, uniques = pd.factorize(self.values)
+    firstname = np.empty(len(uniques) + 1, dtype = object)
+    lastname = np.empty(len(uniques) + 1, dtype = object)
+    firstname[-1] = lastname[-1] = np.nan
+
+    pending = {}
+    for i, name in enumerate(uniques):
+        __ = quicksplit(name) if isinstance(name, basestring) else None
+        if __ is None:
+            pending[i] = name
+        else:
+            firstname[i], lastname[i] = __
+
+    if pending:
+        parsed = splitnames(pending.values(), **kwds)
+        for i, name in pending.items():
+            firstname[i], lastname[i] = parsed[name]
+
+    return pd.DataFrame({
+        'firstname' : pd.Series(firstname).clean().values.take(codes),
+        'lastname' : pd.Series(lastname).clean().values.take(codes)},
+            index = self.index,
+            columns = ['firstname', 'lastname']).drop_blankfields()
 
 #address
 def get_zipdata():
@@ -55,16 +176,51 @@ def get_zipdata():
             .fillna('State Abbreviation')\
             .fillna('Place Name'))
 
+def normalize_city(series):
+    return series.str.strip().str.lower()
+
+def build_zipindex():
+    """Reduce the zipcode data to what address parsing needs:
+        'cities' - one zip code per (state, normalized city),
+        'states' - state name to state abbreviation.
+    """
+    data = get_zipdata()
+    cities = pd.DataFrame({
+        'state' : data['State.1'],
+        'city' : normalize_city(data['Place Name']),
+        'zip' : data['Zip Code']})
+
+    return {'cities' : cities.dropna().drop_duplicates(subset = ['state', 'city'], keep = 'last'),
+            'states' : data.getmapper('State', 'State.1')}
+
+def get_zipindex():
+    """Zip code index, built once from zipcodes.zip and kept in
+        memory and on disk (zipindex.pkl) until zipcodes.zip changes.
+    """
+    if not ZIPINDEX:
+        source = joinpath(ZIPCODEDIR, 'zipcodes.zip')
+        path = joinpath(ZIPCODEDIR, 'zipindex.pkl')
+        if ospath.exists(path) and ospath.getmtime(path) >= ospath.getmtime(source):
+            ZIPINDEX.update(pd.read_pickle(path))
+        else:
+            ZIPINDEX.update(build_zipindex())
+            try:
+                pd.to_pickle(dict(ZIPINDEX), path)
+            except (IOError, OSError) as e: #read-only install; rebuilt next run
+                record_logger.warning("Could not save the zip code index to '%s' (%s)" % (path, e))
+    return ZIPINDEX
+
 def get_zipcodes(df):
     if not hasattr(df, 'state'):
         return df
 
-    for state, data in get_zipdata().groupby('State.1'):
-        msk = (df.state == state) & (no_zipcode(df))
-        zipmap = idict(
-            data.getmapper('Place Name', 'Zip Code'))
+    msk = (no_zipcode(df)) & (df.state.notnull()) & (df.city.notnull())
+    if msk.any():
+        keys = pd.DataFrame({'state' : df.loc[msk, 'state'],
+                             'city' : normalize_city(df.loc[msk, 'city'])})
 
-        df.loc[msk, 'zip'] = df.loc[msk, 'city'].map(lambda x: zipmap.get(x))
+        df.loc[msk, 'zip'] = keys.merge(get_zipindex()['cities'],
+            how = 'left', on = ['state', 'city'])['zip'].values
     return df
 
 def is_valid_us_address(df):
@@ -78,8 +234,47 @@ def no_zipcode(df):
 def addressconcat(df):
     return df.joinfields(fields = USAddress.fields)
 
+def parse_prepped(x):
+    return USAddress(x, prepped = x).components
+
+def parse_addresses(addresses, processes = None, cache = True):
+    """
+     Batch USAddress.parse.  Addresses are precleaned once per distinct value
+     and deduplicated AFTER cleaning, so variants that clean to the same string
+     are parsed once.  Results are cached on disk (keyed by the cleaned string)
+     across runs and files; remaining misses are parsed in a process pool.
+     Returns a pd.DataFrame of address components indexed like addresses.
+
+     Parameters
+     ----------
+     addresses : pd.Series (no nulls)
+     [processes] : Number of worker processes, 1 to parse in this process.  int
+     [cache] : Read / write the address cache (see get_cache); a directory path
+        overrides the cache location.  bool / str
+    """
+    codes, uniques = pd.factorize(addresses.values)
+    prepped = [USAddress.preclean(x) for x in uniques]
+    keys = set(prepped)
+
+    store = get_cache('addresses.db', cache = cache)
+    parsed = store.get_many(keys) if store else {}
+    misses = [k for k in keys if k not in parsed]
+    if misses:
+        preload()
+        __ = dict(zip(misses, poolmap(parse_prepped, misses,
+            processes = processes, minsize = POOL_MINSIZE,
+            chunksize = 250, initializer = preload)))
+
+        parsed.update(__)
+        if store:
+            cache_update(store, __)
+
+    components = [parsed[k] for k in prepped]
+    return pd.DataFrame([components[i] for i in codes],
+                        index = addresses.index)
+
 @dtypeobject
-def addressdisect(addresses):
+def addressdisect(addresses, **kwds):
     """
      Takes a series containing joined address strings as values, e.g. '1234 Main st. CITY, ST 12345-0000',
      and attempts to disect each one into individual components (address1, address2, city, state, zip).
@@ -87,15 +282,10 @@ def addressdisect(addresses):
      Parameters
      ----------
      addresses : pd.Series
+     [kwds] : Keyword arguments for parse_addresses (processes, cache).
     """
-    disected = addresses\
-        .dropna()\
-        .quickmap(USAddress.parse)\
-        .to_dict()
-
     df = get_zipcodes(
-        pd.DataFrame(disected.values(),
-                     index = disected.keys()))
+        parse_addresses(addresses.dropna(), **kwds))
 
     __ = (~no_zipcode(df)) &\
          (is_valid_us_address(df))
@@ -108,17 +298,38 @@ def addressdisect(addresses):
     return df.assign(
         address1 = df.address1.combine_first(addresses))
 
+def preload():
+    USAddress.preload()
+
 class USAddress(object):
-    cnfg = readjson(joinpath(LABELDIR, 'addresslabels.json'))
-    labels = {k:([v] if not isinstance(v,list) else v)
-              for k,v in cnfg['labels'].items()}
+    @lazyclassattr
+    def cnfg(cls):
+        return readjson(joinpath(LABELDIR, 'addresslabels.json'))
+
+    @lazyclassattr
+    def labels(cls):
+        return {k:([v] if not isinstance(v,list) else v)
+                for k,v in cls.cnfg['labels'].items()}
+
+    @lazyclassattr
+    def fields(cls):
+        return sorted(cls.labels.keys())
 
-    fields = sorted(labels.keys())
-    states = idict(get_zipdata().getmapper('State', 'State.1'))
+    @lazyclassattr
+    def states(cls):
+        return idict(get_zipindex()['states'])
+
+    @classmethod
+    def preload(cls):
+        """Load reference data now rather than on first use.  Called before
+            starting worker processes so forked workers share the parent's
+            copy, and as the worker initializer where processes are spawned.
+        """
+        return cls.cnfg, cls.labels, cls.fields, cls.states
 
-    def __init__(self, address):
+    def __init__(self, address, prepped = None):
         self.orig = address
-        self.prepped = self.preclean(address)
+        self.prepped = prepped or self.preclean(address)
         self.components = self.disect()
         self.components['fulladdress'] = self.prepped
 
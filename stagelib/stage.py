@@ -251,8 +251,9 @@ class Stage(GenericBase):
         for name, fields in self.fieldgroups.items():
             func = self._getfunc(name)
             if func:
-                if (name == 'datetime_fields' and kwds.get('formatdates')):
-                    func = partial(func, fmt = True)
+                if name == 'datetime_fields':
+                    func = partial(func, fmt = bool(kwds.get('formatdates')),
+                                   source = getattr(self, 'filename', None))
 
                 f = df.filterfields(items = fields).astype(str)
                 if f.any():
@@ -265,11 +266,9 @@ class Stage(GenericBase):
         df = self.parse(df, *args, **kwds)
         if hasattr(self, 'errorcatch'):
             self.errorcatch.evaluate(df)
-            errors = [(k, v) for k, v in self.errorcatch._errors.items()
-                      if k in self.errorcatch.table.loc[self.errorcatch.errors, 'shortname'].values]
-
-            conditions = {name : {'mask' : lambda df: df.index.isin(data.index)}
-                          for name, data in errors}
+            failed = self.errorcatch.table.loc[self.errorcatch.errors, 'shortname'].values
+            conditions = {name : {'mask' : lambda df, mask = mask: mask.reindex(df.index).values}
+                          for name, mask in self.errorcatch.masks.items() if name in failed}
             self.ready = self.errorcatch.ready
         return self.droprows(df, conditions = conditions)
 
@@ -298,8 +297,7 @@ class Stage(GenericBase):
             self.ready = True
         return self
 
-    def _processfile(self, path_or_file, *args, **kwds):
-        self.info("START")
+    def _openfile(self, path_or_file, **kwds):
         self._file = path_or_file
         if isinstance(path_or_file, (str, basestring)):
             self._file = File.guess(path_or_file,
@@ -315,12 +313,7 @@ class Stage(GenericBase):
             if self.badlinescount >= 1:
                 self.warning("%s bad lines have been found in '%s'." % (self.badlinescount, self.filename))
 
-        _ = newfolder( kwds.get('outdir', 'processed') )
-        outfile = kwds.get('outfile')
-        if not outfile:
-            outfile = self._file.get_outfile(self.filename,
-                                            dirname = _)
-        createcsv(outfile, self.fields)
+    def _iterprocess(self, *args, **kwds):
         for df in self._file.dfreader:
             try:
                 df = self.process(df, *args, **kwds)
@@ -328,12 +321,31 @@ class Stage(GenericBase):
                 self.normalized += len(df)
             except IncompleteExcelFile as e:
                 self.incomplete_excel += 1
-            
+            yield df
+
+        self.emptysheets = getattr(self._file, 'emptysheets', None)
+
+    def iterprocess(self, path_or_file, *args, **kwds):
+        """Processed chunks of `path_or_file`, without writing them anywhere
+        (e.g. for `BaseModel.loaddfs`).  Call `evaluate` once exhausted.
+        """
+        self._openfile(path_or_file, **kwds)
+        return self._iterprocess(*args, **kwds)
+
+    def _processfile(self, path_or_file, *args, **kwds):
+        self.info("START")
+        self._openfile(path_or_file, **kwds)
+        _ = newfolder( kwds.get('outdir', 'processed') )
+        outfile = kwds.get('outfile')
+        if not outfile:
+            outfile = self._file.get_outfile(self.filename,
+                                            dirname = _)
+        createcsv(outfile, self.fields)
+        for df in self._iterprocess(*args, **kwds):
             File.append(outfile, df.to_csvstring(header = False))
             self.info("%s rows written to %s" % (len(df), outfile))
             gc.disable(); gc.collect()
 
-        self.emptysheets = getattr(self._file, 'emptysheets', None)
         self.info("END"); print
         return self.evaluate()
 
@@ -342,6 +354,7 @@ class Stage(GenericBase):
         Csv.savebadlines(self._file.path,
                          self.badlines,
                          outfile = outfile,
+                         delimiter = self._file.delimiter,
                          _fixed = self.header)
 
     @requiresattr('errorcatch')
@@ -1,17 +1,237 @@
-import re
+import os, re, json, sqlite3, contextlib
 from collections import defaultdict
 import textract
 
-from files import ospath, File, Folder
+from generic import GenericBase, chunker, poolimap, logging_setup
+from files import ospath, File, Folder, DiskCache, filehandler, getmd5, joinpath, sqltext
+
+TEXTCACHEDIR = joinpath('data', 'text')
+EXTRACT_EXTENSIONS = ('.pdf',)
+re_TOKEN = re.compile(r'\w+')
+SQLITE_MAXVARS = 900
+textminer_logger = logging_setup(name = __name__)
 
 def extract_text(path):
     return textract.process(path)
 
-def pdf2txt(path):
-    outfile = "%s.txt" % ospath(path).stem
-    if not ospath.exists(outfile):
-        File.write(outfile, extract_text(path))
-    return outfile
+@filehandler(mode = 'rb')
+def readtext(fh):
+    return fh.read()
+
+def _extract(args):
+    """Worker: extract `path` into `outfile` (written to a temp file first,
+        so a half-written cache entry is never picked up).
+    """
+    path, outfile = args
+    try:
+        if not ospath.exists(outfile):
+            tempfile = "%s.%s.temp" % (outfile, os.getpid())
+            File.write(tempfile, extract_text(path))
+            os.rename(tempfile, outfile)
+        return path, outfile, None
+    except Exception as e:
+        return path, None, str(e)
+
+class TextCache(object):
+    """Content-addressed store of extracted text.
+
+    Text is saved as '<md5 of source>.txt' in `dirname`, so renamed or copied
+    files are extracted once and edited files get a fresh entry.  A manifest
+    of path -> (mtime, size, md5) avoids rehashing sources that haven't changed.
+    """
+    def __init__(self, dirname = TEXTCACHEDIR):
+        if not ospath.exists(dirname):
+            os.makedirs(dirname)
+        self.dirname = dirname
+        self.manifest = DiskCache(joinpath(dirname, 'manifest.db'))
+
+    def keys(self, paths):
+        paths = map(ospath.abspath, paths)
+        known = self.manifest.get_many(paths)
+        keys, changed = {}, {}
+        for path in paths:
+            stat = os.stat(path)
+            entry = known.get(path)
+            if entry and entry[:2] == [stat.st_mtime, stat.st_size]:
+                keys[path] = entry[2]
+            else:
+                keys[path] = getmd5(path)
+                changed[path] = [stat.st_mtime, stat.st_size, keys[path]]
+        if changed:
+            self.manifest.update(changed)
+        return keys
+
+    def textpaths(self, paths):
+        return {path : joinpath(self.dirname, "%s.txt" % key)
+                for path, key in self.keys(paths).items()}
+
+def extract_texts(paths, processes = None, cache = None):
+    """Yield (path, textpath) for each path as its text becomes available.
+        Cached documents come first; the rest are extracted in a process pool
+        and streamed back in completion order.  Files that need no extraction
+        are their own textpath.
+    """
+    cache = cache or TextCache()
+    paths = list(paths)
+    toextract = [path for path in paths if path.lower().endswith(EXTRACT_EXTENSIONS)]
+    for path in paths:
+        if path not in toextract:
+            yield path, path
+
+    textpaths = cache.textpaths(toextract)
+    pending = defaultdict(list) #identical documents are extracted once
+    for path in toextract:
+        textpath = textpaths[ospath.abspath(path)]
+        if ospath.exists(textpath):
+            yield path, textpath
+        else:
+            pending[textpath].append(path)
+
+    jobs = [(paths[0], textpath) for textpath, paths in pending.items()]
+    for path, textpath, error in poolimap(_extract, jobs, processes = processes, minsize = 2):
+        if error:
+            textminer_logger.error("Could not extract text from '%s': %s" % (path, error))
+            continue
+        for path in pending[textpath]:
+            yield path, textpath
+
+def pdf2txt(path, cache = None):
+    for _, textpath in extract_texts([path], processes = 1, cache = cache):
+        return textpath
+
+def tokenize(text):
+    return re_TOKEN.findall(text.lower())
+
+class TextIndex(object):
+    """Persistent inverted index (sqlite3) over extracted text:
+        token -> document -> byte offsets of the lines containing it.
+
+    Postings are keyed on an indexed `token` column; a separate vocabulary
+    of distinct tokens resolves keyword fragments (substring matches, like
+    the search regex) to indexed tokens, so the postings table is never scanned.
+    Documents are re-indexed only when their text file changes, so the
+    index can be updated incrementally as files are added.
+
+    Parameters:
+    -----------
+    [path] : Database file. str
+    """
+    def __init__(self, path = joinpath(TEXTCACHEDIR, 'index.db')):
+        self.path = path
+        self.vocabulary = {}
+        with contextlib.closing(self.connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS docs (doc TEXT PRIMARY KEY, textpath TEXT, mtime REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS postings (token TEXT, doc TEXT, offsets TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY)")
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+            conn.execute("DROP INDEX IF EXISTS postings_token") #superseded by postings_token_doc
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_token_doc ON postings (token, doc)")
+            if not conn.execute("SELECT 1 FROM tokens LIMIT 1").fetchone(): #index built before the vocabulary
+                conn.execute("INSERT OR IGNORE INTO tokens (token) SELECT DISTINCT token FROM postings")
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.path)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout = 60)
+
+    @property
+    def docs(self):
+        with contextlib.closing(self.connect()) as conn:
+            return dict(conn.execute("SELECT doc, textpath FROM docs"))
+
+    def add(self, doc, textpath):
+        """(Re)index `doc` from `textpath` unless it is already current.
+            Returns True if the document was indexed.
+        """
+        doc, textpath = sqltext(doc), sqltext(textpath)
+        mtime = os.path.getmtime(textpath)
+        with contextlib.closing(self.connect()) as conn, conn:
+            if conn.execute("SELECT 1 FROM docs WHERE doc = ? AND textpath = ? AND mtime = ?",
+                            (doc, textpath, mtime)).fetchone():
+                return False
+
+            postings, offset = defaultdict(list), 0
+            with open(textpath, 'rb') as fh:
+                for line in fh:
+                    for token in set(tokenize(line)):
+                        postings[token].append(offset)
+                    offset += len(line)
+
+            conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+            conn.executemany("INSERT INTO postings (token, doc, offsets) VALUES (?, ?, ?)",
+                             ((token, doc, json.dumps(offsets)) for token, offsets in postings.items()))
+            conn.executemany("INSERT OR IGNORE INTO tokens (token) VALUES (?)",
+                             ((token,) for token in postings))
+            conn.execute("INSERT OR REPLACE INTO docs (doc, textpath, mtime) VALUES (?, ?, ?)",
+                         (doc, textpath, mtime))
+
+        for fragment, tokens in self.vocabulary.items():
+            tokens.update(token for token in postings if fragment in token)
+        return True
+
+    def update(self, docs):
+        """Index (doc, textpath) pairs, skipping unchanged ones.  Returns the number indexed."""
+        return sum(self.add(doc, textpath) for doc, textpath in docs)
+
+    def remove(self, doc):
+        doc = sqltext(doc)
+        with contextlib.closing(self.connect()) as conn, conn:
+            conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+            conn.execute("DELETE FROM docs WHERE doc = ?", (doc,))
+
+    def tokens(self, fragment, conn):
+        """Indexed tokens containing `fragment`.  Resolved once from the vocabulary
+            and kept current by `add`.
+        """
+        if fragment not in self.vocabulary:
+            self.vocabulary[fragment] = {token for (token,) in conn.execute(
+                "SELECT token FROM tokens WHERE token LIKE ? ESCAPE '\\'",
+                ('%' + fragment.replace('_', '\\_') + '%',))}
+        return self.vocabulary[fragment]
+
+    def lookup(self, keyword, docs = None):
+        """{doc : set of line offsets} for lines holding every token of `keyword`
+            (as a substring, like the search regex), or None if `keyword` has no tokens.
+
+        Parameters:
+        ----------
+        keyword : Search term. str
+        [docs] : Restrict the result to these documents, all if None. list
+        """
+        fragments = tokenize(keyword)
+        if not fragments:
+            return None
+
+        if docs is not None:
+            docs = set(map(sqltext, docs))
+
+        found = None
+        with contextlib.closing(self.connect()) as conn:
+            for fragment in fragments:
+                lines = defaultdict(set)
+                for tokens in chunker(self.tokens(fragment, conn), SQLITE_MAXVARS):
+                    sql, params = ("SELECT doc, offsets FROM postings WHERE token IN (%s)" % ', '.join('?' * len(tokens)),
+                                   tokens)
+                    if docs is not None and len(docs) == 1:
+                        sql += " AND doc = ?"; params = tokens + list(docs)
+
+                    for _doc, offsets in conn.execute(sql, params):
+                        if docs is None or _doc in docs:
+                            lines[_doc].update(json.loads(offsets))
+                if found is not None:
+                    lines = {k : v & found[k] for k, v in lines.items() if v & found.get(k, set())}
+                found = lines
+        return found
+
+    @staticmethod
+    @filehandler(mode = 'rb')
+    def readlines(fh, offsets):
+        lines = []
+        for offset in sorted(offsets):
+            fh.seek(offset)
+            lines.append(fh.readline())
+        return lines
 
 class TextSearch(GenericBase):
     def __init__(self, keywords = [], *args, **kwds):
@@ -25,21 +245,67 @@ class TextSearch(GenericBase):
     def get_matches(self, data):
         return self.regex.findall(data)
 
+    def results(self, path, matches, require_all = False):
+        return [{'keyword' : term, 'match' : match, 'path' : path}
+                for term in self.keywords for match in matches if term in match
+                and (not require_all or all(t in match for t in self.keywords))]
+
+    def search_index(self, index, docs = None, require_all = False, textpaths = None):
+        """Yield matches per document using `index` (TextIndex): only the lines
+            that hold the keywords' tokens are read back and checked with the regex.
+
+        Parameters:
+        ----------
+        index : TextIndex.
+        [docs] : Documents to search, all indexed documents if None. list
+        [require_all] : Only sentences containing every keyword. bool
+        [textpaths] : Indexed document -> text file, read from `index` if None. dict
+        """
+        if textpaths is None:
+            textpaths = index.docs
+        subset = docs is not None
+        docs = [doc for doc in docs if sqltext(doc) in textpaths] if subset else textpaths.keys()
+        if not docs:
+            return
+
+        #one lookup per keyword, across all the documents
+        found = [index.lookup(keyword, docs = docs if subset else None) for keyword in self.keywords]
+        for doc in docs:
+            key = sqltext(doc)
+            if any(lines is None for lines in found): #nothing to look up; read it all
+                lines = readtext(textpaths[key]).splitlines(True)
+            else:
+                offsets = [lines.get(key, set()) for lines in found]
+                offsets = set.intersection(*offsets) if require_all else set.union(set(), *offsets)
+                lines = index.readlines(textpaths[key], offsets)
+
+            matches = [match for line in lines for match in self.regex.findall(line)]
+            yield self.results(doc, matches, require_all = require_all)
+
     def search(self, *args, **kwds):
         raise NotImplementedError
 
 class FolderTextSearch(TextSearch):
-    def __init__(self, keywords = [], dirname = '.'):
+    def __init__(self, keywords = [], dirname = '.', processes = None, cachedir = TEXTCACHEDIR, indexed = True):
         super(FolderTextSearch, self).__init__(dirname = dirname, keywords = keywords)
+        self.processes = processes
+        self.cache = TextCache(cachedir)
+        self.index = TextIndex(joinpath(cachedir, 'index.db')) if indexed else None
 
     def get_matches(self, path):
-        return super(FolderTextSearch, self).get_matches(File.read(path))
+        return super(FolderTextSearch, self).get_matches(readtext(path))
 
     def search(self, *args, **kwds):
-        for path in Folder.listdir(self.dirname, **kwds):
-            if path.lower().endswith('.pdf'):
-                path = pdf2txt(path)
-
-            yield [{'keyword' : term, 'match' : match, 'path' : path}
-                    for term in self.keywords for
-                    match in self.get_matches(path) if term in match]
+        """Yield the matches for each file as soon as its text is available
+            (documents are extracted in parallel, and cached between runs).
+        """
+        require_all = kwds.pop('require_all', False)
+        paths = Folder.listdir(self.dirname, **kwds)
+        for path, textpath in extract_texts(paths, processes = self.processes, cache = self.cache):
+            if self.index:
+                self.index.add(path, textpath)
+                for results in self.search_index(self.index, docs = [path], require_all = require_all,
+                                                 textpaths = {sqltext(path) : sqltext(textpath)}):
+                    yield results
+            else:
+                yield self.results(path, self.get_matches(textpath), require_all = require_all)
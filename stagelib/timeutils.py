@@ -1,12 +1,17 @@
 import re
 import datetime
+from collections import OrderedDict
 import logging
 from dateutil.relativedelta import relativedelta
 import pytz
 import pandas as pd
 from pandas.tslib import Timestamp
+try:
+    from pandas.core.tools.datetimes import _guess_datetime_format
+except ImportError:
+    from pandas.tseries.tools import _guess_datetime_format
 
-from generic import mergedicts, attribute_generator, logging_setup
+from generic import logging_setup, LRUCache
 #from files import importpandas
 
 #pd = None
@@ -14,8 +19,20 @@ date_logger = logging.getLogger(__name__)
 logging_setup(logger = date_logger)
 re_DATE = re.compile(r'.*?(2\d{3})(?:[-\.\/])?(\d{2})(?:[-\.\/])?(\d{2}).*')
 re_EPOCH = re.compile(r'^\d{5}(?:\.0)?$')
+re_DATESEP = re.compile(r'[-\.\/]')
+re_DATEPARTS = r'^\s*(\d{1,4})[-\.\/](\d{1,2})[-\.\/](\d{1,4})'
 
 DATE_FORMAT_LIST = ["%m%d%Y", "%Y%m%d"]
+CANDIDATE_FORMATS = DATE_FORMAT_LIST + [
+    "%m/%d/%y", "%d/%m/%y", "%m/%d/%Y", "%d/%m/%Y",
+    "%m-%d-%y", "%d-%m-%y", "%b, %d %Y", "%b %d, %Y", "%m/%d/%Y %H:%M"]
+DATE_CACHESIZE = 250000
+DATEPARTS = OrderedDict([('year', 'year'), ('month', 'month'), ('day', 'day'),
+                         ('hour', 'hour'), ('minute', 'minute'), ('second', 'second'),
+                         ('wday', 'dayofweek'), ('yday', 'dayofyear'), ('quarter', 'quarter')])
+_MISSING = object()
+DAYFIRST_SAMPLESIZE = 5000
+DAYFIRST = LRUCache(1000)
 
 def utcnow():
     return Timestamp(pytz.utc.localize(datetime.datetime.now()))
@@ -23,6 +40,18 @@ def utcnow():
 def n_months_ago(n):
     return datetime.datetime.today() - relativedelta(months = n)
 
+def twodigit_year(year):
+    """Century for a two-digit year, as dateutil (so `parse_date`) picks it:
+        the one less than 50 years away from the current year.
+    """
+    current = datetime.date.today().year
+    year += current // 100 * 100
+    if year >= current + 50:
+        year -= 100
+    elif year < current - 50:
+        year += 100
+    return year
+
 def epoch_to_datetime(epoch):
     return Timestamp(datetime.date(1900,1,1) + datetime.timedelta(float(epoch) - 2))
 
@@ -30,7 +59,7 @@ def is_dayfirst(date):
     """
     Date.is_dayfirst('24/12/2015') == True
     """
-    _ = re.compile(r'[-\.\/]').split(str(date))
+    _ = re_DATESEP.split(str(date))
     month = _[0]
     if len(month) > 2:
         try:
@@ -44,6 +73,42 @@ def is_dayfirst(date):
     except ValueError:
         return False
 
+def infer_dayfirst(series, samplesize = DAYFIRST_SAMPLESIZE, source = None):
+    """Decide whether a column's numeric dates put the day first.
+
+    Parses day/month positions out of a sample of the distinct values
+    with str.extract.  Values whose first position is above 12 vote
+    dayfirst, and values whose second position is above 12 vote monthfirst.
+    For year-first dates the two positions after the year count.
+    Decisions are cached per (source, column) once any value has voted.
+
+    Returns:
+    --------
+    (dayfirst, confidence), where confidence is the winning share of the votes.
+    """
+    key = (source, series.name)
+    if source and key in DAYFIRST:
+        return DAYFIRST.get(key)
+
+    values = pd.Series(series.dropna().unique()).astype(str)
+    if len(values) > samplesize:
+        values = values.sample(samplesize, random_state = 0)
+
+    parts = values.str.extract(re_DATEPARTS, expand = True).dropna()
+    yearfirst = parts[0].str.len() > 2
+    first = parts[0].where(~yearfirst, parts[1]).astype(int)
+    second = parts[1].where(~yearfirst, parts[2]).astype(int)
+    daysfirst = ((first > 12) & (second <= 12)).sum()
+    monthsfirst = ((second > 12) & (first <= 12)).sum()
+    votes = daysfirst + monthsfirst
+    if not votes:
+        return False, 0.
+
+    result = (bool(daysfirst > monthsfirst), max(daysfirst, monthsfirst) / float(votes))
+    if source:
+        DAYFIRST[key] = result
+    return result
+
 def try_date_formats(date):
     for _ in DATE_FORMAT_LIST:
         try:
@@ -51,12 +116,90 @@ def try_date_formats(date):
         except ValueError as e:
             pass #; date_logger.error(e)
 
+def parse_date(date, dayfirst = False, **kwds):
+    """General parse chain: excel epoch, then pd.to_datetime, then DATE_FORMAT_LIST."""
+    if re_EPOCH.search(date):
+        return epoch_to_datetime(date)
+    try:
+        return pd.to_datetime(date, dayfirst = dayfirst, **kwds)
+    except ValueError as e:
+        return pd.to_datetime(try_date_formats(date))
+
+class DateParser(object):
+    """Date parser for one column.
+
+    Keeps an ordered list of strptime formats learned from the column's values,
+    trying the last successful one first, and only falls back to `parse_date`
+    when none of them fit.  Two-digit years get `parse_date`'s century either way.
+    Results go in a bounded cache kept by the parser, so repeated values are
+    parsed once across chunks and files.
+    """
+    PARSERS = {}
+
+    def __init__(self, name = None, dayfirst = False):
+        self.name = name
+        self.dayfirst = dayfirst
+        self.formats = []
+        self.cache = LRUCache(DATE_CACHESIZE)
+
+    @classmethod
+    def get(cls, name = None, dayfirst = False):
+        key = (name, dayfirst)
+        if key not in cls.PARSERS:
+            cls.PARSERS[key] = cls(name, dayfirst = dayfirst)
+        return cls.PARSERS[key]
+
+    def learn(self, date, result):
+        guessed = _guess_datetime_format(date, dayfirst = self.dayfirst)
+        for fmt in [guessed] + CANDIDATE_FORMATS:
+            if not fmt or fmt in self.formats or not self.fits(fmt):
+                continue
+            try:
+                if self._strptime(date, fmt) == result:
+                    self.formats.insert(0, fmt)
+                    return fmt
+            except ValueError:
+                pass
+
+    def fits(self, fmt):
+        """Day/month order of `fmt` agrees with `dayfirst` (so that ambiguous
+        values parse the same way as through `parse_date`).
+        """
+        day, month = fmt.find('%d'), fmt.find('%m')
+        return day < 0 or month < 0 or (day < month) == self.dayfirst
+
+    @staticmethod
+    def _strptime(date, fmt):
+        result = datetime.datetime.strptime(date, fmt)
+        if '%y' in fmt:
+            return result.replace(year = twodigit_year(result.year % 100))
+        return result
+
+    def strptime(self, date):
+        for i, fmt in enumerate(self.formats):
+            try:
+                result = self._strptime(date, fmt)
+            except ValueError:
+                continue
+            if i:
+                self.formats.insert(0, self.formats.pop(i))
+            return Timestamp(result)
+
+    def parse(self, date):
+        result = self.cache.get(date, _MISSING)
+        if result is _MISSING:
+            result = self.strptime(date)
+            if result is None:
+                result = parse_date(date, dayfirst = self.dayfirst)
+                if result is not None and result is not pd.NaT:
+                    self.learn(date, result)
+            self.cache[date] = result
+        return result
+
 class BadDate(Exception):
     pass
 
 class Date(object):
-    FIELDMAP = {'mon' : 'month', 'mday': 'day', 'min': 'minute', 'sec': 'second'}
-
     def __init__(self, date, strfmt = '%Y-%m-%d', **kwds):
         self.strfmt = strfmt
         self.date = self.to_datetime(date, **kwds)
@@ -70,7 +213,7 @@ class Date(object):
         raise BadDate(self.date)
 
     @classmethod
-    def parse(cls, date, fmt = False, disect = False, force = False, **kwds):
+    def parse(cls, date, fmt = False, disect = False, force = False, fields = [], **kwds):
         _ = cls(date, **kwds)
         if fmt:
             try:
@@ -79,7 +222,7 @@ class Date(object):
                 if force:
                     date_logger.warning("Value '{}' truncated.".format(date))
         elif disect:
-            return _.disect()
+            return _.disect(fields)
         else:
             return _.date
 
@@ -87,7 +230,7 @@ class Date(object):
     def is_epoch(date):
         return True if re_EPOCH.search(date) else False
 
-    def to_datetime(self, date, dayfirst = False, **kwds):
+    def to_datetime(self, date, dayfirst = False, parser = None, **kwds):
         try:
             assert isinstance(date, str)
         except:
@@ -95,17 +238,12 @@ class Date(object):
                 return
             date = str(date)
 
-        if Date.is_epoch(date):
-            return epoch_to_datetime(date)
-        try:
-            return pd.to_datetime(date, dayfirst = dayfirst, **kwds)
-        except ValueError as e:
-            return pd.to_datetime(try_date_formats(date))
-        return date
-
-    def disect(self):
-        __ = map(lambda x: (x[0].split('_')[1], x[1]),
-                 attribute_generator(self.date.timetuple()))
+        if parser and not kwds: #options for pd.to_datetime (errors, format, utc, ...) skip the fast path
+            return parser.parse(date)
+        return parse_date(date, dayfirst = dayfirst, **kwds)
 
-        _ = {self.FIELDMAP.get(k, k) : v for (k, v) in __}
-        return mergedicts(_, quarter = self.date.quarter)
+    def disect(self, fields = []):
+        """Parts of the date (keys of DATEPARTS), limited to `fields` if given."""
+        if self.date is None:
+            return {}
+        return {k : getattr(self.date, DATEPARTS[k]) for k in fields or DATEPARTS}
@@ -1,10 +1,12 @@
 from __future__ import division
-import re
+import os, re, tempfile
+from contextlib import contextmanager
 from collections import defaultdict, OrderedDict
 from functools import wraps
+import numpy as np
 import pandas as pd
 from generic import GenericBase, mergedicts
-from files import df2excel
+from files import df2excel, joinpath
 import dataframe
 
 #validations
@@ -16,25 +18,96 @@ re_INVALID_DATE  = re.compile(r'^(?:(?![1-9]\d{3}-\d{2}-\d{2}$).*)')
 re_EPOCH = re.compile(r'^1970-01-01$')
 re_INVALID_NAME = re.compile(r'^(?:[^a-z]+|^[^\s]+)$', re.I)
 
+SHAREDMASKS = None
+
+def sharedmask(func):
+    """Compute func(df, *args) once per frame while Errorcatch.runchecks
+        is evaluating it, so checks built on the same intermediate mask share it.
+        Outside of 'sharingmasks' nothing is memoized.
+    """
+    @wraps(func)
+    def inner(df, *args):
+        if SHAREDMASKS is None:
+            return func(df, *args)
+        key = (func.__name__, id(df), args)
+        if key not in SHAREDMASKS:
+            SHAREDMASKS[key] = (df, func(df, *args)) #df is kept alive so its id can't be reused
+        return SHAREDMASKS[key][1]
+    return inner
+
+@contextmanager
+def sharingmasks():
+    """Scope of one round of checks for 'sharedmask'."""
+    global SHAREDMASKS
+    previous, SHAREDMASKS = SHAREDMASKS, {}
+    try:
+        yield
+    finally:
+        SHAREDMASKS = previous
+
+@sharedmask
+def fieldnotnull(df, field):
+    return df[field].notnull()
+
 def notnull(field):
     def decorator(func):
         @wraps(func)
         def inner(df, *args, **kwds):
-            return (df[field].notnull()) & (func(df, *args, **kwds))
+            return (fieldnotnull(df, field)) & (func(df, *args, **kwds))
         return inner
     return decorator
 
 def checkstacked(**filters):
+    """Apply func to the non-null values of each filtered column.
+        Returns a boolean pd.DataFrame (rows x filtered columns).
+    """
     def decorator(func):
         @wraps(func)
         def inner(df, **kwds):
-            return func(df.filter(**filters).stack())\
-                .unstack()\
-                .fillna(False)\
-                .reindex(df.index)
+            __ = {}
+            for field in df.filterfields(**filters):
+                values = df[field].dropna()
+                __[field] = func(values).reindex(df.index).fillna(False)
+            return pd.DataFrame(__, index = df.index)
         return inner
     return decorator
 
+def reservoir(sample, df, mask, seen, size):
+    """Update sample, a uniform random sample (at most size rows) of the
+        'seen' rows found so far, with the rows of df where mask is True.
+        Vectorized Algorithm R: only rows that end up in the sample are copied.
+    """
+    positions = np.flatnonzero(mask.values)
+    room = max(size - len(sample), 0)
+    sample = pd.concat([sample, df.iloc[positions[:room]]])
+    positions = positions[room:]
+    if not len(positions):
+        return sample
+
+    t = seen + room + np.arange(len(positions))
+    slots = (np.random.random(len(positions)) * (t + 1)).astype(int)
+    keep = slots < size
+    slots, positions = slots[keep], positions[keep]
+    if not len(slots):
+        return sample
+
+    __, last = np.unique(slots[::-1], return_index = True) #later rows replace earlier ones
+    last = len(slots) - 1 - last
+    order = np.arange(len(sample))
+    order[slots[last]] = len(sample) + np.arange(len(last))
+    return pd.concat([sample, df.iloc[positions[last]]]).iloc[order]
+
+def mergesamples(a, seen_a, b, seen_b, size):
+    """Combine two uniform samples of seen_a and seen_b rows into one uniform sample of the union."""
+    n = min(size, len(a) + len(b))
+    if not seen_a or not seen_b:
+        return pd.concat([a, b]).iloc[:n]
+
+    from_a = np.random.hypergeometric(seen_a, seen_b, n)
+    return pd.concat([
+        a.iloc[np.random.choice(len(a), from_a, replace = False)],
+        b.iloc[np.random.choice(len(b), n - from_a, replace = False)]])
+
 def invalid_name(series):
     return series.contains(re_INVALID_NAME)
     
@@ -46,10 +119,19 @@ def is_valid_name(series, **kwds):
 
 class Errorcatch(GenericBase):
     ADDITIONS = {}
+    SAMPLESIZE = 1000
+    SPOOLDIR = tempfile.gettempdir() #flagged rows are spooled here for save(full = True); None keeps samples only
     def __init__(self, *args, **kwds):
         schema = kwds.pop('schema', '')
+        samplesize = kwds.pop('samplesize', self.SAMPLESIZE)
+        spooldir = kwds.pop('spooldir', self.SPOOLDIR)
         super(Errorcatch, self).__init__(schema, *args, **kwds)
+        self.samplesize = samplesize
+        self.spooldir = spooldir
         self.length = 0
+        self.masks = {}
+        self.seen = defaultdict(int)
+        self.spooled = defaultdict(list)
         self._errors = defaultdict(pd.DataFrame)
         self.table = pd.DataFrame({
             'shortname' : [],
@@ -67,7 +149,11 @@ class Errorcatch(GenericBase):
         self.length += other.length
         self._addcounts(other.table)
         for k, v in other._errors.items():
-            self._errors[k].append(v)
+            self._errors[k] = mergesamples(self._errors[k], self.seen[k],
+                                           v, other.seen[k], self.samplesize)
+            self.seen[k] += other.seen[k]
+        for k, v in other.spooled.items():
+            self.spooled[k].extend(i for i in v if i not in self.spooled[k])
         return self
 
     @property
@@ -89,27 +175,57 @@ class Errorcatch(GenericBase):
             __[level].extend(items)
         return __
 
+    @staticmethod
+    def rowmask(mask):
+        if isinstance(mask, pd.DataFrame):
+            return mask.any(axis = 1)
+        return mask
+
     def runchecks(self, df):
+        """Evaluate every check in the checklist against df in one pass.
+            Checks sharing a function, or intermediate masks (see 'sharedmask'),
+            are only computed once.
+        """
         __ = []
-        for level, items in self.checklist.items():
-            __.extend([
-                mergedicts(item, level = level, mask = item['func'](df))
-                for item in items
-                    ])
+        masks = {}
+        with sharingmasks():
+            for level, items in self.checklist.items():
+                for item in items:
+                    func = item['func']
+                    if func not in masks:
+                        masks[func] = self.rowmask(func(df))
+                    __.append(mergedicts(item, level = level, mask = masks[func]))
         return __
 
+    def spool(self, name, df, mask):
+        """Append the rows of df where mask is True to this check's spool file."""
+        path = joinpath(self.spooldir, "%s.%s-%s.csv" % (name, os.getpid(), id(self)))
+        header = path not in self.spooled[name]
+        try:
+            df.loc[mask].to_csv(path, mode = 'a', header = header, index = False, encoding = 'utf-8')
+        except (IOError, OSError) as e:
+            self.warning("Spooling to '%s' failed, keeping samples only (%s)" % (self.spooldir, e))
+            self.spooldir = None
+            return
+        if header:
+            self.spooled[name].append(path)
+
     def parse(self, item, df):
         desc = item['desc']
         level = item['level']
         name = item['name']
         mask = item['mask']
-        data = df.loc[mask].drop_blankfields()
         count = mask.sum()
+        self.masks[name] = mask
         if count > 0:
             getattr(self, level.lower())("%s rows found where '%s'" % (count, desc))
 
-        if not data.empty:
-            self._errors[name] = data
+            if self.spooldir:
+                self.spool(name, df, mask)
+
+            self._errors[name] = reservoir(self._errors[name], df, mask,
+                                           self.seen[name], self.samplesize)
+            self.seen[name] += count
 
         return {
             'shortname' : name,
@@ -132,6 +248,7 @@ class Errorcatch(GenericBase):
 
     def evaluate(self, df):
         self.length += len(df)
+        self.masks = {}
         self.info("Checking for errors ....")
         
         self._addcounts(pd.DataFrame([
@@ -141,11 +258,36 @@ class Errorcatch(GenericBase):
         self._reconcile()
         return self
 
-    def save(self, outfile, **kwds):
+    def readspooled(self, name, chunksize = 50000):
+        for path in self.spooled[name]:
+            if not os.path.exists(path): #already saved (and removed) by an instance merged into this one
+                continue
+            for df in pd.read_csv(path, dtype = object, chunksize = chunksize):
+                yield df
+
+    def save(self, outfile, full = False, **kwds):
+        """Write errors to outfile, one sheet per check.  By default each sheet
+            holds the check's sample; with full = True, spooled checks stream
+            every spooled row (split across sheets past Excel's row limit).
+            Spool files are removed once saved.
+        """
         self.info("One moment please.  Saving errors to '%s'." % outfile)
-        sheets = OrderedDict(mergedicts(self._errors, **kwds))
+        sheets = OrderedDict()
+        for name, data in self._errors.items():
+            if full and self.spooled[name]:
+                sheets[name] = self.readspooled(name)
+            else:
+                sheets[name] = data.drop_blankfields()
+
+        sheets = OrderedDict(mergedicts(sheets, **kwds))
         df2excel(outfile, **sheets)
         delattr(self, '_errors')
+        for path in set(sum(self.spooled.values(), [])):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.spooled.clear()
         
     def showresults(self, **kwds):
         print self.table.sort_values(by = ['count', 'level'],
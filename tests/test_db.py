@@ -0,0 +1,42 @@
+import os, sys, unittest
+import pandas as pd
+from peewee import SqliteDatabase, CharField, IntegerField
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stagelib'))
+try:
+    import db
+except ImportError: #MySQLdb
+    db = None
+
+@unittest.skipIf(db is None, "stagelib.db dependencies are not installed")
+class TestLoaddfReplace(unittest.TestCase):
+    def setUp(self):
+        Base = db.get_basemodel(SqliteDatabase(':memory:'))
+        class Code(Base):
+            code = CharField(unique = True)
+            n = IntegerField(null = True)
+
+        Code.create_table()
+        self.Code = Code
+
+    def test_pk_and_unique_columns(self):
+        Code = self.Code
+        Code.loaddf(pd.DataFrame({'id' : [1, 2], 'code' : ['a', 'b'], 'n' : [1, 2]}))
+        rejected = []
+        inserted = Code.loaddf(pd.DataFrame({'id' : [1, 3], 'code' : ['a', 'c'], 'n' : [10, 3]}),
+                               conflict = 'replace', rejected = rejected)
+        self.assertEqual(inserted, 2)
+        self.assertEqual(rejected, [])
+        self.assertEqual(sorted(Code.select(Code.id, Code.code, Code.n).tuples()),
+                         [(1, 'a', 10), (2, 'b', 2), (3, 'c', 3)])
+
+    def test_statement_errors_are_raised(self):
+        Code = self.Code
+        Code.drop_table()
+        rejected = []
+        with self.assertRaises(Exception):
+            Code.loaddf(pd.DataFrame({'code' : ['a', 'b'], 'n' : [1, 2]}), rejected = rejected)
+        self.assertEqual(rejected, [])
+
+if __name__ == '__main__':
+    unittest.main()
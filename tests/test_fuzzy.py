@@ -0,0 +1,31 @@
+import unittest
+import pandas as pd
+
+from stagelib.fuzzy import get_rankings
+
+X_NAMES = ['Acme Holdings LLC', 'Acme Hldgs', 'Smith and Sons Trust', 'Smith & Son',
+           'Northwest Bank of the Americas', 'North West Capital Partners', 'Acme Group Intl',
+           'Group Son', 'Intl Holdings Acme']
+Y_NAMES = ['Acme Holdings Inc', 'ACME Holding Co', 'Acme International Group', 'Smith Sons Trust Co',
+           'Smith Family Trust', 'Northwest Bank', 'North-West Capital', 'Bank of the Americas North',
+           'Group Northwest of Americas', 'International Northwest', 'Intl Trust Partners Co']
+
+def scores(rankings):
+    return {(x, y) : (total, partial) for x, y, total, partial in
+            rankings[['x_index', 'y_index', 'ratio_total', 'ratio_partial']].itertuples(index = False)}
+
+class TestTopCandidates(unittest.TestCase):
+    def setUp(self):
+        self.x_df = pd.DataFrame({'name' : X_NAMES})
+        self.y_df = pd.DataFrame({'name' : Y_NAMES})
+
+    def test_topk_agrees_with_full_mode(self):
+        full = scores(get_rankings(self.x_df, self.y_df, 'name'))
+        for k in (1, 2, len(Y_NAMES)):
+            ranked = scores(get_rankings(self.x_df, self.y_df, 'name', topk = k))
+            self.assertTrue(ranked)
+            for pair, score in ranked.items():
+                self.assertEqual(score, full[pair])
+
+if __name__ == '__main__':
+    unittest.main()